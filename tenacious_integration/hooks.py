@@ -148,6 +148,18 @@ app_license = "mit"
 doc_events = {
     "*": {
         "on_update": "tenacious_integration.tenacious_integration.whatsapp_webhook.send_whatsapp_on_workflow_transition"
+    },
+    "Workflow": {
+        "on_update": "tenacious_integration.tenacious_integration.whatsapp_webhook.clear_workflow_meta_cache",
+        "on_trash": "tenacious_integration.tenacious_integration.whatsapp_webhook.clear_workflow_meta_cache"
+    },
+    "Custom Field": {
+        "on_update": "tenacious_integration.tenacious_integration.whatsapp_webhook.clear_workflow_meta_cache",
+        "on_trash": "tenacious_integration.tenacious_integration.whatsapp_webhook.clear_workflow_meta_cache"
+    },
+    "User": {
+        "on_update": "tenacious_integration.tenacious_integration.whatsapp_webhook.clear_workflow_recipients_cache",
+        "on_trash": "tenacious_integration.tenacious_integration.whatsapp_webhook.clear_workflow_recipients_cache"
     }
 }
 
@@ -174,6 +186,14 @@ doc_events = {
 # 	],
 # }
 
+scheduler_events = {
+    "all": [
+        "tenacious_integration.tenacious_integration.dispatcher.enqueue_dispatch",
+        "tenacious_integration.tenacious_integration.message_status.enqueue_flush_status_buffer",
+        "tenacious_integration.tenacious_integration.whatsapp_webhook.flush_notification_digests"
+    ]
+}
+
 # Testing
 # -------
 
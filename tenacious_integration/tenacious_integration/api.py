@@ -1,21 +1,80 @@
 import json
+import time
 import frappe
 import requests
 from frappe import _
-from twilio.rest import Client
+from frappe.utils import time_diff_in_seconds
+from tenacious_integration.tenacious_integration.circuit_breaker import (
+    CLOSED,
+    CircuitOpenError,
+    acquire,
+    get_circuit_status,
+    record_failure,
+    record_success,
+)
+from tenacious_integration.tenacious_integration.dispatcher import (
+    PRIORITIES,
+    UNCONFIRMED_ERROR,
+    dispatch,
+    enqueue_dispatch,
+    enqueue_high_priority_dispatch,
+    get_bucket,
+    prepare_message,
+)
+from tenacious_integration.tenacious_integration.doctype.twilio_sms_log.twilio_sms_log import bulk_insert_sms_logs
+from tenacious_integration.tenacious_integration.doctype.whatsapp_message_log.whatsapp_message_log import (
+    bulk_insert_message_logs,
+)
+from tenacious_integration.tenacious_integration.idempotency import claim_send, finish_send
+from tenacious_integration.tenacious_integration.message_status import apply_status_update, buffer_status_callback
+from tenacious_integration.tenacious_integration.phone import normalize_recipient
+from tenacious_integration.tenacious_integration.settings import get_settings
+from tenacious_integration.tenacious_integration.twilio_client import (
+    get_twilio_client,
+    is_transient_error,
+    is_valid_twilio_request,
+    may_have_been_sent,
+)
+from tenacious_integration.tenacious_integration.webhook_log import log_webhook_event
+
+# Bulk sends that would take longer than this at the sender rate are queued for
+# the dispatcher instead of holding a web worker
+BULK_SEND_SYNC_SECONDS = 5
+
+BULK_INSERTERS = {
+    "WhatsApp Message Log": bulk_insert_message_logs,
+    "Twilio SMS Log": bulk_insert_sms_logs,
+}
+
+# Fields read from Twilio callbacks; everything else in the body is ignored
+STATUS_CALLBACK_FIELDS = ("MessageSid", "MessageStatus", "ErrorCode", "ErrorMessage")
+DEBUGGER_EVENT_FIELDS = ("Sid", "AccountSid", "ParentAccountSid", "Timestamp", "Level", "Payload")
+
+
+def get_webhook_payload(fields):
+    """
+    Read a webhook body. Twilio posts callbacks as application/x-www-form-urlencoded,
+    which Frappe has already parsed into request.form, so only the listed fields
+    are picked from it. JSON bodies (e.g. from a forwarding proxy) are still accepted;
+    with Validate Webhook Signatures on they must be signed with bodySHA256.
+    """
+    if frappe.request.mimetype == "application/x-www-form-urlencoded":
+        form = frappe.request.form
+        return {field: form[field] for field in fields if field in form}
+
+    return json.loads(frappe.request.get_data(as_text=True))
 
 
 @frappe.whitelist()
 def test_twilio_connection():
     """Test the connection to Twilio API"""
     try:
-        settings = frappe.get_single("Twilio Settings")
-        
-        if not settings.account_sid or not settings.auth_token:
+        settings = get_settings("Twilio Settings")
+        client = get_twilio_client(settings)
+
+        if not client:
             return {"success": False, "error": "Twilio credentials are missing in Twilio Settings"}
         
-        client = Client(settings.account_sid, settings.get_password("auth_token"))
-        
         # Fetch account details as a test
         account = client.api.accounts(settings.account_sid).fetch()
         
@@ -34,31 +93,60 @@ def send_whatsapp_message(doc_name):
     try:
         # Fetch the message document
         message = frappe.get_doc("WhatsApp Message Log", doc_name)
-        settings = frappe.get_single("Twilio Settings")
-        
-        if not settings.account_sid or not settings.auth_token:
-            return {"success": False, "error": "Twilio credentials are missing in Twilio Settings"}
-        
-        client = Client(settings.account_sid, settings.get_password("auth_token"))
+        settings = get_settings("Twilio Settings")
+        client = get_twilio_client(settings)
 
-        # Ensure recipient and sender numbers are correctly formatted
-        recipient_number = f"whatsapp:+{message.to_number.strip()}"
-        sender_number = settings.twilio_whatsapp_number.strip()
+        if not client:
+            return {"success": False, "error": "Twilio credentials are missing in Twilio Settings"}
 
-        # ✅ Send the message exactly as done in manual test
-        twilio_message = client.messages.create(
-            from_=sender_number,
-            body=message.message_content,
-            to=recipient_number
+        # ✅ Never send a message Twilio has already accepted
+        if message.message_id:
+            return {"success": True, "message_id": message.message_id, "duplicate": True}
+
+        # ✅ Twilio may have accepted it already; only an explicit resend sends it again
+        if message.status == "Unconfirmed":
+            return {"success": False, "error": UNCONFIRMED_ERROR}
+
+        # ✅ Same sender, Messaging Service and rate budget as the dispatcher would use
+        msg = prepare_message(
+            settings,
+            "WhatsApp Message Log",
+            message.name,
+            message.to_number,
+            message.message_content,
+            message.creation,
+            message.priority,
         )
 
+        # ✅ Reject malformed numbers before spending a Twilio round trip on them
+        if not msg.to:
+            error = f"Invalid phone number {message.to_number}"
+            message.update_status("Failed", error)
+            return {"success": False, "error": error}
+
+        claimed, sid = claim_send("WhatsApp Message Log", message.name)
+        if not claimed and not sid:
+            return {"success": False, "error": "Message is already being sent"}
+
+        if claimed:
+            # ✅ Fail fast while Twilio is down; the dispatcher sends the message once it recovers
+            try:
+                acquire("Twilio")
+            except CircuitOpenError as e:
+                finish_send("WhatsApp Message Log", message.name, {"deferred": True})
+                message.db_set("status", "Queued")
+                return {"success": False, "queued": True, "error": str(e)}
+
+            sid = send_prepared_message(client, settings, msg)
+
         # ✅ Update status in WhatsApp Message Log
-        message.message_id = twilio_message.sid
+        message.message_id = sid
         message.status = "Sent"
         message.sent_at = frappe.utils.now()
+        message.queue_wait = time_diff_in_seconds(message.sent_at, msg.queued_since)
         message.save(ignore_permissions=True)
 
-        return {"success": True, "message_id": twilio_message.sid}
+        return {"success": True, "message_id": sid}
 
     except Exception as e:
         frappe.log_error("Error sending Twilio WhatsApp message", frappe.get_traceback())
@@ -69,13 +157,16 @@ def twilio_webhook_handler():
     """
     Handles incoming Twilio webhook events for message delivery updates & Debugger events.
     """
+    # ✅ With signature validation on, only Twilio may change message statuses; checked outside the try so forgeries are not logged
+    if not is_valid_twilio_request():
+        raise frappe.PermissionError(_("Invalid Twilio signature"))
+
     try:
         # ✅ Get incoming payload
-        payload = frappe.request.get_data(as_text=True)
-        data = json.loads(payload)
+        data = get_webhook_payload(STATUS_CALLBACK_FIELDS + DEBUGGER_EVENT_FIELDS)
 
-        # ✅ Log the complete payload for debugging
-        frappe.log_error(title="Twilio Webhook Received", message=json.dumps(data, indent=2))
+        # ✅ Keep a sample of payloads for debugging
+        log_webhook_event("twilio_webhook_handler", data)
 
         # ✅ Handle Twilio Debugger Event
         if "Sid" in data and "Payload" in data:
@@ -85,14 +176,17 @@ def twilio_webhook_handler():
                 "parent_account_sid": data.get("ParentAccountSid", "N/A"),
                 "timestamp": data.get("Timestamp"),
                 "level": data.get("Level"),
-                "payload": json.dumps(data.get("Payload", {}), indent=2)
+                "payload": data.get("Payload") if isinstance(data.get("Payload"), str) else json.dumps(data.get("Payload", {}), indent=2)
             }
 
-            # ✅ Store Debugger event in Error Log
-            frappe.log_error(
-                title=f"Twilio Debugger Event [{debugger_event['level']}]",
-                message=json.dumps(debugger_event, indent=2)
-            )
+            # ✅ Store Debugger errors in Error Log, keep everything else in the webhook event log
+            if (debugger_event["level"] or "").upper() == "ERROR":
+                frappe.log_error(
+                    title=f"Twilio Debugger Event [{debugger_event['level']}]",
+                    message=json.dumps(debugger_event, indent=2)
+                )
+            else:
+                log_webhook_event("twilio_debugger", debugger_event, force=True)
             
             return {"success": True, "message": "Debugger event logged successfully"}
 
@@ -101,17 +195,10 @@ def twilio_webhook_handler():
             message_sid = data.get("MessageSid")
             status = data.get("MessageStatus")
 
-            message_log = frappe.get_all(
-                "WhatsApp Message Log",
-                filters={"message_id": message_sid},
-                fields=["name"]
-            )
-
-            if message_log:
-                message = frappe.get_doc("WhatsApp Message Log", message_log[0].name)
-                message.status = status.capitalize()
-                message.save(ignore_permissions=True)
-                frappe.db.commit()
+            if get_settings("Twilio Settings").buffer_status_callbacks:
+                buffer_status_callback("WhatsApp Message Log", message_sid, status, data.get("ErrorCode"), data.get("ErrorMessage"))
+            else:
+                apply_status_update("WhatsApp Message Log", message_sid, status, data.get("ErrorCode"), data.get("ErrorMessage"))
 
             return {"success": True, "message": f"Message {message_sid} updated to {status}"}
 
@@ -149,11 +236,6 @@ def generate_webhook_url(doc_name):
         return {"success": False, "error": str(e)}
 
 
-import json
-import frappe
-from frappe import _
-from twilio.rest import Client
-
 @frappe.whitelist()
 def send_twilio_sms(doc_name=None, to_number=None, message_content=None):
     """
@@ -161,58 +243,232 @@ def send_twilio_sms(doc_name=None, to_number=None, message_content=None):
     Supports sending via a `Twilio SMS Log` document or direct arguments.
     """
     try:
-        settings = frappe.get_single("Twilio Settings")
+        settings = get_settings("Twilio Settings")
+        client = get_twilio_client(settings)
 
-        if not settings.account_sid or not settings.auth_token:
+        if not client:
             return {"success": False, "error": "Twilio credentials are missing in Twilio Settings"}
 
-        client = Client(settings.account_sid, settings.get_password("auth_token"))
-
         # ✅ If `doc_name` is provided, fetch from `Twilio SMS Log`
         if doc_name:
             try:
                 sms = frappe.get_doc("Twilio SMS Log", doc_name)  # Ensure this matches your Doctype name
-                to_number = f"+{sms.to_number.strip()}"
-                message_content = sms.message_content
             except frappe.DoesNotExistError:
                 return {"success": False, "error": f"Twilio SMS Log '{doc_name}' not found"}
 
+            msg = prepare_message(
+                settings, "Twilio SMS Log", sms.name, sms.to_number, sms.message_content, sms.creation, sms.priority
+            )
+
+            # ✅ Reject malformed numbers before spending a Twilio round trip on them
+            if not msg.to:
+                error = f"Invalid phone number {sms.to_number}"
+                sms.db_set({"status": "Failed", "error_message": error})
+                return {"success": False, "error": error}
+
         # ✅ Handle direct API calls (without doc_name)
         else:
             if not to_number or not message_content:
                 return {"success": False, "error": "Missing `to_number` or `message_content`"}
-            to_number = f"+{to_number.strip()}"
+            # Unlogged sends are transactional, so they may use the High priority reserve
+            msg = prepare_message(settings, "Twilio SMS Log", None, to_number, message_content, priority="High")
+            if not msg.to:
+                return {"success": False, "error": f"Invalid phone number {to_number}"}
+
+        # ✅ A logged SMS is claimed by its idempotency key so retries never send it twice
+        if doc_name:
+            if sms.message_sid:
+                return {"success": True, "message_id": sms.message_sid, "duplicate": True}
 
-        sender_number = f"{settings.twilio_sms_number.strip()}"
+            if sms.status == "Unconfirmed":
+                return {"success": False, "error": UNCONFIRMED_ERROR}
+
+            claimed, sid = claim_send("Twilio SMS Log", sms.name)
+            if not claimed and not sid:
+                return {"success": False, "error": "Message is already being sent"}
+        else:
+            claimed, sid = True, None
 
         # ✅ Send SMS via Twilio
-        twilio_message = client.messages.create(
-            from_=sender_number,
-            body=message_content,
-            to=to_number
-        )
+        if claimed:
+            # ✅ Fail fast while Twilio is down; a logged SMS stays Queued for the dispatcher
+            try:
+                acquire("Twilio")
+            except CircuitOpenError as e:
+                if doc_name:
+                    finish_send("Twilio SMS Log", sms.name, {"deferred": True})
+                    sms.db_set("status", "Queued")
+                return {"success": False, "queued": bool(doc_name), "error": str(e)}
+
+            sid = send_prepared_message(client, settings, msg)
 
         # ✅ Update status if doc_name was provided
         if doc_name:
-            sms.message_sid = twilio_message.sid
+            sms.message_sid = sid
             sms.status = "Queued"
             sms.date_sent = frappe.utils.now()
+            sms.queue_wait = time_diff_in_seconds(sms.date_sent, msg.queued_since)
             sms.save(ignore_permissions=True)
 
-        return {"success": True, "message_id": twilio_message.sid}
+        return {"success": True, "message_id": sid}
 
     except Exception as e:
         frappe.log_error("Error sending Twilio SMS", frappe.get_traceback())
         return {"success": False, "error": str(e)}
     
+def send_prepared_message(client, settings, msg):
+    """
+    Send one message built by prepare_message from its assigned sender, on the
+    sender's account and within its rate budget, like the dispatcher does.
+    """
+    if msg.account_sid != settings.account_sid:
+        client = get_twilio_client(settings, msg.account_sid)
+
+    get_bucket(msg.account_sid, msg.sender_key, msg.rate, msg.priority).acquire()
+    return create_twilio_message(client, msg.doctype, msg.name, body=msg.body, to=msg.to, **msg.sender)
+
+
+def create_twilio_message(client, doctype, name, **kwargs):
+    """
+    Create one Twilio message, settling the idempotency claim of its log row
+    (when `name` is given) and recording the outcome on Twilio's circuit breaker.
+    """
+    try:
+        sid = client.messages.create(**kwargs).sid
+    except Exception as e:
+        if is_transient_error(e):
+            record_failure("Twilio")
+        else:
+            record_success("Twilio")
+
+        if name:
+            # A send Twilio may have accepted is held for review rather than retried
+            result = {"error": str(e), "unconfirmed": may_have_been_sent(e)}
+            if result["unconfirmed"]:
+                frappe.db.set_value(doctype, name, {"status": "Unconfirmed", "error_message": f"{UNCONFIRMED_ERROR}: {e}"})
+            finish_send(doctype, name, result)
+        raise
+
+    record_success("Twilio")
+    if name:
+        finish_send(doctype, name, {"sid": sid})
+    return sid
+
+
+@frappe.whitelist()
+def send_bulk_sms(recipients, message_content=None, priority="Normal"):
+    """
+    Sends one SMS per recipient. `recipients` is a list of numbers sharing
+    `message_content`, or of {"to_number", "message_content"} dicts.
+    """
+    return send_bulk("Twilio SMS Log", recipients, message_content, priority)
+
+
+@frappe.whitelist()
+def send_bulk_whatsapp_messages(recipients, message_content=None, priority="Normal"):
+    """
+    Sends one WhatsApp message per recipient. `recipients` is a list of numbers
+    sharing `message_content`, or of {"to_number", "message_content"} dicts.
+    """
+    return send_bulk("WhatsApp Message Log", recipients, message_content, priority)
+
+
+def send_bulk(doctype, recipients, message_content=None, priority="Normal"):
+    """
+    Log all messages with one bulk insert, then send them concurrently through
+    the pooled client. Batches that would take more than BULK_SEND_SYNC_SECONDS
+    at the configured rate are left Queued for the background dispatcher, as
+    are messages still unsent when that time runs out (e.g. backing off a 429).
+    Returns one result per recipient, in order.
+    """
+    frappe.has_permission(doctype, "create", throw=True)
+
+    if priority not in PRIORITIES:
+        frappe.throw(_("Invalid priority {0}").format(priority))
+
+    settings = get_settings("Twilio Settings")
+    client = get_twilio_client(settings)
+
+    if not client:
+        return {"success": False, "error": "Twilio credentials are missing in Twilio Settings"}
+
+    results, rows = [], []
+    for recipient in frappe.parse_json(recipients) or []:
+        if isinstance(recipient, dict):
+            to_number, body = recipient.get("to_number"), recipient.get("message_content") or message_content
+        else:
+            to_number, body = recipient, message_content
+
+        to_number = str(to_number or "").strip()
+        result = frappe._dict(to=to_number)
+        results.append(result)
+
+        if not to_number or not body:
+            result.update(status="Failed", error="Missing `to_number` or `message_content`")
+            continue
+
+        # Malformed numbers fail here, without a log row or a Twilio call
+        normalized = normalize_recipient(settings, to_number)
+        if not normalized:
+            result.update(status="Failed", error=f"Invalid phone number {to_number}")
+            continue
+        to_number = normalized
+
+        rows.append((result, {"to_number": to_number, "message_content": body, "priority": priority}))
+
+    # While Twilio's circuit is not closed, leave everything to the dispatcher
+    sync_limit = int((settings.messages_per_second or 1) * BULK_SEND_SYNC_SECONDS)
+    send_now = len(rows) <= sync_limit and get_circuit_status("Twilio").state == CLOSED
+    if send_now:
+        # Claim the rows so the background dispatcher leaves them to this request
+        now = frappe.utils.now()
+        claim_token = frappe.generate_hash(length=16)
+        for _result, log in rows:
+            log.update(claim_token=claim_token, claimed_at=now)
+
+    names = BULK_INSERTERS[doctype]([log for _result, log in rows])
+    frappe.db.commit()
+
+    messages = []
+    for (result, log), name in zip(rows, names):
+        result.update(log=name, status="Queued")
+        messages.append(
+            prepare_message(settings, doctype, name, log["to_number"], log["message_content"], priority=priority)
+        )
+
+    if messages and send_now:
+        outcome = dispatch(client, settings, messages, deadline=time.monotonic() + BULK_SEND_SYNC_SECONDS)
+        for (result, _log), msg in zip(rows, messages):
+            if msg.result.get("sid"):
+                result.update(status="Sent", sid=msg.result["sid"])
+            elif msg.result.get("unconfirmed"):
+                result.update(status="Unconfirmed", error=UNCONFIRMED_ERROR)
+            elif not any(msg.result.get(key) for key in ("deferred", "transient", "skipped")):
+                result.update(status="Failed", error=msg.result.get("error"))
+
+        # Twilio failed, its circuit opened or time ran out part way through; the rest go out with the dispatcher
+        if outcome["deferred"]:
+            enqueue_dispatch()
+    elif messages and priority == "High":
+        enqueue_high_priority_dispatch()
+    elif messages:
+        enqueue_dispatch()
+
+    return {"success": True, "results": results}
+
+
 @frappe.whitelist(allow_guest=True)
 def twilio_sms_webhook():
     """
     Handles incoming Twilio webhook events for SMS delivery updates.
     """
+    if not is_valid_twilio_request():
+        raise frappe.PermissionError(_("Invalid Twilio signature"))
+
     try:
-        payload = frappe.request.get_data(as_text=True)
-        data = json.loads(payload)
+        data = get_webhook_payload(STATUS_CALLBACK_FIELDS)
+
+        log_webhook_event("twilio_sms_webhook", data)
 
         if "MessageStatus" in data:
             message_sid = data.get("MessageSid")
@@ -220,19 +476,10 @@ def twilio_sms_webhook():
             error_code = data.get("ErrorCode")
             error_message = data.get("ErrorMessage")
 
-            sms_log = frappe.get_all(
-                "Twilio SMS Log",
-                filters={"message_sid": message_sid},
-                fields=["name"]
-            )
-
-            if sms_log:
-                sms = frappe.get_doc("Twilio SMS Log", sms_log[0].name)
-                sms.status = status.capitalize()
-                sms.error_code = error_code if error_code else None
-                sms.error_message = error_message if error_message else None
-                sms.save(ignore_permissions=True)
-                frappe.db.commit()
+            if get_settings("Twilio Settings").buffer_status_callbacks:
+                buffer_status_callback("Twilio SMS Log", message_sid, status, error_code, error_message)
+            else:
+                apply_status_update("Twilio SMS Log", message_sid, status, error_code, error_message)
 
             return {"success": True}
 
@@ -0,0 +1,226 @@
+import gzip
+import hashlib
+import math
+import os
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Backup artifacts are streamed to OneDrive as zstd, optionally wrapped in
+# AES-256-GCM, without writing the encoded copy to disk. Gzipped backup
+# artifacts (the database dump) are inflated on the fly so zstd sees the raw
+# SQL; site files are encoded as they are, so they decode to their own hash.
+#
+# Encrypted layout: MAGIC, scrypt salt, nonce prefix, then frames of up to
+# FRAME_SIZE plaintext bytes, each sealed with nonce = prefix + frame counter.
+# Given the same parameters the output is byte-for-byte identical, so an
+# interrupted upload can resume by encoding again and skipping what Graph has.
+
+BUFFER_SIZE = 1024 * 1024  # bytes read from the source at a time
+FRAME_SIZE = 1024 * 1024  # plaintext bytes per AES-GCM frame
+MAGIC = b"TIB1"
+SALT_SIZE = 16
+NONCE_PREFIX_SIZE = 8
+TAG_SIZE = 16
+HEADER_SIZE = len(MAGIC) + SALT_SIZE + NONCE_PREFIX_SIZE
+LAST_FRAME = b"last"  # associated data of the final frame, so a truncated file fails to decrypt
+
+
+def check_available():
+    if not zstandard:
+        raise ImportError("Backup compression needs the zstandard package")
+
+
+def new_params(level, encrypt, inflate=True):
+    """Parameters fixing the encoded bytes of one upload, kept with its upload session."""
+    check_available()
+    return {
+        "level": level,
+        "inflate": inflate,
+        "zstd": zstandard.__version__,
+        "salt": os.urandom(SALT_SIZE).hex() if encrypt else None,
+        "nonce_prefix": os.urandom(NONCE_PREFIX_SIZE).hex() if encrypt else None,
+    }
+
+
+def derive_key(passphrase, salt):
+    return hashlib.scrypt(passphrase.encode(), salt=salt, n=2**14, r=8, p=1, dklen=32)
+
+
+def read_source(path, inflate):
+    opener = gzip.open if inflate and path.endswith(".gz") else open
+    with opener(path, "rb") as source:
+        while chunk := source.read(BUFFER_SIZE):
+            yield chunk
+
+
+def compress(chunks, level):
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    for chunk in chunks:
+        if data := compressor.compress(chunk):
+            yield data
+    yield compressor.flush()
+
+
+def encrypt(chunks, key, salt, nonce_prefix):
+    aead = AESGCM(key)
+    yield MAGIC + salt + nonce_prefix
+
+    buffer = bytearray()
+    counter = 0
+    for chunk in chunks:
+        buffer += chunk
+        # Hold back at least one byte, so the final frame is never a full one we already sealed
+        while len(buffer) > FRAME_SIZE:
+            yield aead.encrypt(nonce_prefix + counter.to_bytes(4, "big"), bytes(buffer[:FRAME_SIZE]), None)
+            del buffer[:FRAME_SIZE]
+            counter += 1
+
+    yield aead.encrypt(nonce_prefix + counter.to_bytes(4, "big"), bytes(buffer), LAST_FRAME)
+
+
+def encode(path, params, passphrase=None):
+    """Generator of the encoded bytes of a backup file."""
+    return seal(compress(read_source(path, params["inflate"]), params["level"]), params, passphrase)
+
+
+def seal(chunks, params, passphrase):
+    """Encrypt compressed chunks when the parameters ask for it."""
+    if not params.get("salt"):
+        return chunks
+
+    salt = bytes.fromhex(params["salt"])
+    return encrypt(chunks, derive_key(passphrase, salt), salt, bytes.fromhex(params["nonce_prefix"]))
+
+
+def measure(path, params, passphrase=None, keep_limit=0):
+    """
+    Size of the encoded stream, which Graph needs before the first range, from
+    one compression pass without touching disk; encryption adds a fixed
+    overhead per frame. A stream of at most `keep_limit` bytes is returned too,
+    so small files are uploaded from memory instead of compressed twice.
+    """
+    size, kept = 0, []
+    for chunk in compress(read_source(path, params["inflate"]), params["level"]):
+        size += len(chunk)
+        if kept is not None and size <= keep_limit:
+            kept.append(chunk)
+        else:
+            kept = None
+
+    if params.get("salt"):
+        size += HEADER_SIZE + TAG_SIZE * max(math.ceil(size / FRAME_SIZE), 1)
+
+    if kept is None or size > keep_limit:
+        return size, None
+    return size, b"".join(seal(kept, params, passphrase))
+
+
+def encoded_size(path, params):
+    """Size of the encoded stream. See measure."""
+    return measure(path, params)[0]
+
+
+def encoded_name(file_name, params):
+    """OneDrive file name of an encoded artifact, e.g. "x-database.sql.gz" -> "x-database.sql.zst.enc"."""
+    if params["inflate"] and file_name.endswith(".gz"):
+        file_name = file_name[:-3]
+    return file_name + (".zst.enc" if params.get("salt") else ".zst")
+
+
+class EncodedFile:
+    """
+    Read-only file object over the encoded stream of a backup file. Seeking
+    forward skips output; seeking backward encodes again from the start.
+    """
+
+    def __init__(self, path, params, passphrase=None):
+        self.path = path
+        self.params = params
+        self.passphrase = passphrase
+        self.restart()
+
+    def restart(self):
+        self.chunks = encode(self.path, self.params, self.passphrase)
+        self.buffer = bytearray()
+        self.position = 0
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.position += len(data)
+        return data
+
+    def seek(self, offset):
+        if offset < self.position:
+            self.restart()
+        while self.position < offset and self.read(min(BUFFER_SIZE, offset - self.position)):
+            pass
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.chunks.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def decode_backup(input_path, output_path, passphrase=None):
+    """
+    Turn a downloaded .zst or .zst.enc artifact back into the plain file, e.g.
+    bench --site x execute tenacious_integration.tenacious_integration.backup_stream.decode_backup
+    --kwargs "{'input_path': '...', 'output_path': '...', 'passphrase': '...'}"
+    """
+    check_available()
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+    with open(input_path, "rb") as source, open(output_path, "wb") as target:
+        header = source.read(HEADER_SIZE)
+
+        if header.startswith(MAGIC):
+            if not passphrase:
+                raise ValueError("This backup is encrypted; a passphrase is needed")
+            salt = header[len(MAGIC) : len(MAGIC) + SALT_SIZE]
+            chunks = decrypt(source, AESGCM(derive_key(passphrase, salt)), header[len(MAGIC) + SALT_SIZE :])
+        else:
+            chunks = read_with_prefix(source, header)
+
+        for chunk in chunks:
+            target.write(decompressor.decompress(chunk))
+        target.write(decompressor.flush())
+
+
+def decrypt(source, aead, nonce_prefix):
+    counter = 0
+    frame = source.read(FRAME_SIZE + TAG_SIZE)
+
+    while True:
+        following = source.read(FRAME_SIZE + TAG_SIZE)
+        last = not following
+        yield aead.decrypt(nonce_prefix + counter.to_bytes(4, "big"), frame, LAST_FRAME if last else None)
+        if last:
+            return
+        frame = following
+        counter += 1
+
+
+def read_with_prefix(source, prefix):
+    yield prefix
+    while chunk := source.read(BUFFER_SIZE):
+        yield chunk
@@ -0,0 +1,119 @@
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import add_to_date, format_datetime, now_datetime
+
+CIRCUIT_KEY_PREFIX = "tenacious_integration:circuit"
+FAILURE_THRESHOLD = 5  # consecutive transient failures that open a circuit
+FAILURE_WINDOW = 5 * 60  # seconds after which a failure streak is forgotten
+RECOVERY_TIMEOUT = 60  # seconds an open circuit waits before letting one probe through
+
+# (connect, read) seconds for calls to each provider
+PROVIDER_TIMEOUTS = {
+    "Twilio": (5, 30),
+    "Microsoft": (5, 30),
+    "Azampay": (5, 30),
+}
+
+CLOSED = "Closed"
+OPEN = "Open"
+HALF_OPEN = "Half Open"
+
+
+class CircuitOpenError(frappe.ValidationError):
+    pass
+
+
+def get_key(provider, name):
+    return frappe.cache().make_key(f"{CIRCUIT_KEY_PREFIX}:{provider}:{name}")
+
+
+def acquire(provider):
+    """
+    Ask the provider's circuit whether a call may go out. Returns CLOSED for a
+    normal call, or HALF_OPEN when this caller is the single probe allowed once
+    an open circuit has waited RECOVERY_TIMEOUT. Raises CircuitOpenError otherwise,
+    so callers fail fast instead of waiting on a provider that is down.
+    """
+    cache = frappe.cache()
+    opened_at = cache.get(get_key(provider, "opened_at"))
+
+    if not opened_at:
+        return CLOSED
+
+    retry_at = float(opened_at) + RECOVERY_TIMEOUT
+    if time.time() >= retry_at and cache.set(get_key(provider, "probe"), 1, nx=True, ex=RECOVERY_TIMEOUT):
+        return HALF_OPEN
+
+    raise CircuitOpenError(
+        _("{0} is unavailable; calls are paused until {1}").format(
+            provider, format_datetime(to_datetime(max(retry_at, time.time())))
+        )
+    )
+
+
+def record_success(provider):
+    """Close the circuit: the provider answered."""
+    pipe = frappe.cache().pipeline(transaction=False)
+    for name in ("failures", "opened_at", "probe"):
+        pipe.delete(get_key(provider, name))
+    pipe.execute()
+
+
+def record_failure(provider, count=1):
+    """
+    Count transient failures (timeouts, connection errors, 5xx). The circuit
+    opens after FAILURE_THRESHOLD in a row, or at once when a half-open probe fails.
+    """
+    cache = frappe.cache()
+    pipe = cache.pipeline(transaction=False)
+    pipe.incrby(get_key(provider, "failures"), count)
+    pipe.expire(get_key(provider, "failures"), FAILURE_WINDOW)
+    pipe.get(get_key(provider, "opened_at"))
+    failures, _expired, opened_at = pipe.execute()
+
+    if opened_at or failures >= FAILURE_THRESHOLD:
+        pipe = cache.pipeline(transaction=False)
+        pipe.set(get_key(provider, "opened_at"), time.time())
+        pipe.delete(get_key(provider, "probe"))
+        pipe.execute()
+        frappe.logger("tenacious_integration").warning(f"Circuit for {provider} opened after {failures} failures")
+
+
+def release_probe(provider):
+    """Give up a half-open permit that was not used, so another caller can probe."""
+    frappe.cache().delete(get_key(provider, "probe"))
+
+
+def get_circuit_status(provider):
+    """Current state of a provider's circuit, for display in its settings."""
+    opened_at, failures = frappe.cache().mget([get_key(provider, "opened_at"), get_key(provider, "failures")])
+
+    if not opened_at:
+        state = CLOSED
+    elif time.time() < float(opened_at) + RECOVERY_TIMEOUT:
+        state = OPEN
+    else:
+        state = HALF_OPEN
+
+    return frappe._dict(
+        state=state,
+        failures=int(failures or 0),
+        opened_at=to_datetime(float(opened_at)) if opened_at else None,
+    )
+
+
+def to_datetime(timestamp):
+    """A Unix timestamp as a datetime in the system time zone."""
+    return add_to_date(now_datetime(), seconds=timestamp - time.time())
+
+
+def describe_circuit(provider):
+    """One-line circuit state for the read-only field in the provider's settings."""
+    status = get_circuit_status(provider)
+
+    if status.state == CLOSED:
+        return _("Closed") if not status.failures else _("Closed ({0} recent failures)").format(status.failures)
+
+    return _("{0} since {1}").format(_(status.state), format_datetime(status.opened_at))
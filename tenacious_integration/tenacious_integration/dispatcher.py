@@ -0,0 +1,520 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import frappe
+from frappe.query_builder.functions import Avg, Count, IfNull, Max
+from frappe.utils import add_to_date, cint, now_datetime, time_diff_in_seconds
+from twilio.base.exceptions import TwilioRestException
+
+from tenacious_integration.tenacious_integration.circuit_breaker import (
+    FAILURE_THRESHOLD,
+    HALF_OPEN,
+    CircuitOpenError,
+    acquire,
+    record_failure,
+    record_success,
+    release_probe,
+)
+from tenacious_integration.tenacious_integration.idempotency import claim_sends, finish_sends
+from tenacious_integration.tenacious_integration.phone import normalize_recipient
+from tenacious_integration.tenacious_integration.sender_pool import get_pool_sender
+from tenacious_integration.tenacious_integration.settings import get_settings
+from tenacious_integration.tenacious_integration.twilio_client import (
+    get_twilio_client,
+    is_transient_error,
+    may_have_been_sent,
+)
+
+MAX_RETRIES = 5
+BACKOFF_BASE = 1  # seconds, doubled on every 429
+BACKOFF_MAX = 30
+COMMIT_EVERY = 50
+BATCH_SIZE = 200
+PRIORITIES = ("High", "Normal", "Low")
+CLAIM_TIMEOUT = 15 * 60  # seconds before a claim from a dead worker can be taken over
+HIGH_PRIORITY_RESERVE = 0.25  # share of each sender's rate kept in its bucket for High priority messages
+UNCONFIRMED_ERROR = (
+    "Twilio did not answer, so the message may have been sent. Check it in the Twilio console before resending"
+)
+
+CHANNELS = {
+    "WhatsApp Message Log": {
+        "channel": "WhatsApp",
+        "sid_field": "message_id",
+        "number_field": "twilio_whatsapp_number",
+        "prefix": "whatsapp:",
+    },
+    "Twilio SMS Log": {
+        "channel": "SMS",
+        "sid_field": "message_sid",
+        "number_field": "twilio_sms_number",
+        "prefix": "",
+    },
+}
+
+RATE_LIMIT_KEY_PREFIX = "tenacious_integration:rate"
+
+# Token bucket kept in Redis, so every worker sending from a number draws on
+# the same budget. Uses Redis' clock, refills by elapsed time, and returns how
+# many seconds to wait (as a string, since Lua numbers come back truncated).
+# A caller with a reserve only takes a token while that many more are left.
+TOKEN_BUCKET_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local reserve = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - updated, 0) * rate)
+local wait = 0
+if tokens >= 1 + reserve then
+    tokens = tokens - 1
+else
+    wait = (1 + reserve - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class TokenBucket:
+    """
+    Token bucket in Redis allowing `rate` acquisitions per second, across all
+    workers, with bursts up to `capacity`. Acquisitions leave `reserve` tokens
+    for callers sharing the key without one. Built on the main thread (the key
+    needs frappe.local); acquire only talks to Redis, so worker threads can call it.
+    """
+
+    def __init__(self, key, rate, capacity=None, reserve=0):
+        cache = frappe.cache()
+        self.key = cache.make_key(key)
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.reserve = reserve
+        self.script = cache.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            wait = float(self.script(keys=[self.key], args=[self.rate, self.capacity, self.reserve]))
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+def get_bucket(account_sid, sender, rate, priority=None):
+    """
+    Return the shared bucket for an account and sender number. Only High
+    priority messages draw on its last HIGH_PRIORITY_RESERVE share, so a bulk
+    drain from the same number cannot starve transactional sends.
+    """
+    reserve = max(rate * HIGH_PRIORITY_RESERVE, 1)
+    return TokenBucket(
+        f"{RATE_LIMIT_KEY_PREFIX}:{account_sid}:{sender}",
+        rate,
+        capacity=max(rate, 1) + reserve,
+        reserve=0 if priority == "High" else reserve,
+    )
+
+
+@frappe.whitelist()
+def dispatch_queued_messages():
+    """Drain the queue now from the form or console."""
+    frappe.only_for("System Manager")
+    return drain_queue()
+
+
+def enqueue_dispatch():
+    """
+    Scheduler entry point: start the high priority lane and the configured
+    number of general drain jobs, skipping any still running.
+    """
+    settings = get_settings("Twilio Settings")
+
+    enqueue_high_priority_dispatch()
+    for i in range(max(cint(settings.dispatch_jobs), 1)):
+        frappe.enqueue(
+            "tenacious_integration.tenacious_integration.dispatcher.drain_queue",
+            queue="long",
+            timeout=3600,
+            job_id=f"tenacious_integration:dispatch:{i}",
+            deduplicate=True,
+        )
+
+
+def enqueue_high_priority_dispatch():
+    """Start the lane that only drains High priority messages, on the short queue so bulk jobs cannot hold it up."""
+    frappe.enqueue(
+        "tenacious_integration.tenacious_integration.dispatcher.drain_queue",
+        queue="short",
+        job_id="tenacious_integration:dispatch:high",
+        deduplicate=True,
+        enqueue_after_commit=True,
+        priorities=("High",),
+    )
+
+
+def drain_queue(batch_size=BATCH_SIZE, max_batches=None, priorities=PRIORITIES):
+    """
+    Send Queued WhatsApp Message Logs and Twilio SMS Logs that have not reached
+    Twilio yet. Rows are claimed a batch at a time, so any number of workers can
+    run this in parallel without sending a message twice, and memory stays
+    bounded by the batch size. Each batch comes from the highest priority in
+    `priorities` that still has messages waiting. While Twilio's circuit is
+    open messages stay Queued for a later run; once it half-opens a single
+    small batch probes whether Twilio is back.
+    """
+    settings = get_settings("Twilio Settings")
+    client = get_twilio_client(settings)
+
+    if not client:
+        frappe.log_error("Twilio Dispatch Error", "Twilio credentials are missing in Twilio Settings")
+        return {"success": False, "error": "Twilio credentials are missing in Twilio Settings"}
+
+    sent = failed = batches = 0
+    claim_token = frappe.generate_hash(length=16)
+
+    while max_batches is None or batches < max_batches:
+        try:
+            permit = acquire("Twilio")
+        except CircuitOpenError:
+            break
+
+        limit = 1 if permit == HALF_OPEN else batch_size
+        messages = []
+        for priority in priorities:
+            for doctype in CHANNELS:
+                messages += get_queued_messages(settings, doctype, claim_token, limit, priority)
+            if messages:
+                break
+
+        if messages:
+            result = dispatch(client, settings, messages)
+            sent += result["sent"]
+            failed += result["failed"]
+            batches += 1
+
+        if permit == HALF_OPEN:
+            # dispatch has already settled the circuit; this only frees an unused probe
+            release_probe("Twilio")
+
+        if not messages:
+            break
+
+    return {"success": True, "sent": sent, "failed": failed}
+
+
+def dispatch(client, settings, messages, deadline=None):
+    """
+    Send prepared messages concurrently and record each outcome on its log row.
+    Each message's outcome is also left on `msg.result`. Every message is first
+    claimed by its idempotency key, so one that is already being sent or was
+    already accepted by Twilio (e.g. a retried job) is never sent twice.
+
+    Transient failures (timeouts, connection errors, 5xx) feed Twilio's circuit
+    breaker and leave the message Queued for a later run, since the fault is
+    Twilio's rather than the message's. After FAILURE_THRESHOLD of them in a
+    row the rest of the batch is not attempted: those messages are released
+    back to the queue too. A send that timed out after the request went out
+    may have been accepted, so it is marked Unconfirmed for review instead.
+
+    With a `deadline` (a time.monotonic() value), messages not sent by then,
+    including ones waiting out a 429 backoff, are deferred to the queue too.
+    """
+    workers = max(cint(settings.dispatch_concurrency), 1)
+    sent = failed = skipped = unconfirmed = 0
+    tripped = threading.Event()
+
+    def send(client, bucket, msg):
+        if tripped.is_set() or (deadline and time.monotonic() > deadline):
+            return {"deferred": True}
+        return send_with_backoff(client, bucket, msg, deadline)
+
+    # Malformed numbers fail here rather than after a round trip that counts against the rate limit
+    for msg in messages:
+        if not msg.to:
+            msg.result = {"error": f"Invalid phone number {msg.to_number}"}
+            record_result(msg, msg.result)
+            failed += 1
+    messages = [msg for msg in messages if msg.to]
+
+    to_send, held = [], []
+    for msg, (claimed, sid) in zip(messages, claim_sends([(msg.doctype, msg.name) for msg in messages])):
+        if claimed:
+            to_send.append(msg)
+        elif sid:
+            # Twilio accepted it on an earlier attempt whose result never reached the log
+            msg.result = {"sid": sid}
+            record_result(msg, msg.result)
+            sent += 1
+        else:
+            msg.result = {"error": "Message is already being sent", "skipped": True}
+            held.append(msg)
+            skipped += 1
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(
+                send,
+                client if msg.account_sid == settings.account_sid else get_twilio_client(settings, msg.account_sid),
+                get_bucket(msg.account_sid, msg.sender_key, msg.rate, msg.priority),
+                msg,
+            ): msg
+            for msg in to_send
+        }
+
+        done, deferred = [], []
+        answered = transient = streak = 0
+        for i, future in enumerate(as_completed(futures), 1):
+            msg = futures[future]
+            result = msg.result = future.result()
+            done.append((msg.doctype, msg.name, result))
+
+            if result.get("deferred"):
+                deferred.append(msg)
+                continue
+
+            if result.get("transient"):
+                transient += 1
+                streak += 1
+                if streak >= FAILURE_THRESHOLD:
+                    tripped.set()
+
+                if result.get("unconfirmed"):
+                    # Never sent again automatically; its idempotency key is kept too
+                    record_result(msg, result)
+                    unconfirmed += 1
+                else:
+                    # Retried once the circuit allows
+                    deferred.append(msg)
+                continue
+
+            record_result(msg, result)
+            answered += 1
+            streak = 0
+
+            if result.get("sid"):
+                sent += 1
+            else:
+                failed += 1
+
+            if i % COMMIT_EVERY == 0:
+                frappe.db.commit()
+                finish_sends(done)
+                done = []
+
+    # Rows another worker is sending go back to the queue now rather than after CLAIM_TIMEOUT
+    release_claims(deferred + held)
+    frappe.db.commit()
+    finish_sends(done)
+
+    if tripped.is_set():
+        record_failure("Twilio", FAILURE_THRESHOLD)
+    elif answered:
+        record_success("Twilio")
+    elif transient:
+        record_failure("Twilio", transient)
+
+    return {
+        "sent": sent,
+        "failed": failed,
+        "skipped": skipped,
+        "deferred": len(deferred),
+        "unconfirmed": unconfirmed,
+    }
+
+
+def release_claims(messages):
+    """Hand claimed rows back to the queue unsent, for the next dispatcher run."""
+    for doctype in CHANNELS:
+        names = [msg.name for msg in messages if msg.doctype == doctype]
+        if names:
+            table = frappe.qb.DocType(doctype)
+            (
+                frappe.qb.update(table)
+                .set(table.claim_token, None)
+                .set(table.claimed_at, None)
+                .where(table.name.isin(names))
+            ).run()
+
+
+def claim_messages(doctype, sid_field, claim_token, limit, priority=None):
+    """
+    Claim up to `limit` unsent Queued rows of a log doctype for this worker and
+    return their names. Rows locked by another worker are skipped, and claims
+    older than CLAIM_TIMEOUT (from a worker that died) are taken over.
+    """
+    table = frappe.qb.DocType(doctype)
+    now = now_datetime()
+    stale_before = add_to_date(now, seconds=-CLAIM_TIMEOUT)
+
+    names = (
+        frappe.qb.from_(table)
+        .select(table.name)
+        .where(table.status == "Queued")
+        .where(IfNull(table[sid_field], "") == "")
+        .where((IfNull(table.claim_token, "") == "") | (table.claimed_at < stale_before))
+        .orderby(table.creation)
+        .limit(limit)
+        .for_update(skip_locked=True)
+    )
+    if priority:
+        names = names.where(table.priority == priority)
+    names = names.run(pluck=True)
+
+    if names:
+        (
+            frappe.qb.update(table)
+            .set(table.claim_token, claim_token)
+            .set(table.claimed_at, now)
+            .where(table.name.isin(names))
+        ).run()
+
+    frappe.db.commit()
+    return names
+
+
+def get_queued_messages(settings, doctype, claim_token, limit, priority=None):
+    """Claim a batch of unsent log rows of one doctype and prepare them for sending."""
+    names = claim_messages(doctype, CHANNELS[doctype]["sid_field"], claim_token, limit, priority)
+    if not names:
+        return []
+
+    return [
+        prepare_message(settings, doctype, row.name, row.to_number, row.message_content, row.creation, row.priority)
+        for row in frappe.get_all(
+            doctype,
+            filters={"name": ["in", names]},
+            fields=["name", "to_number", "message_content", "creation", "priority"],
+        )
+    ]
+
+
+def prepare_message(settings, doctype, name, to_number, body, queued_since=None, priority=None):
+    """
+    Build the send instruction for one log row. A configured Messaging Service
+    SID takes precedence; otherwise the sender pool picks a number for the
+    recipient, falling back to the channel's single sender number. A number
+    that does not normalize to E.164 leaves `msg.to` empty.
+    """
+    channel = CHANNELS[doctype]
+    normalized = normalize_recipient(settings, to_number)
+    msg = frappe._dict(
+        doctype=doctype,
+        name=name,
+        to_number=to_number,
+        to=normalized and f"{channel['prefix']}{normalized}",
+        body=body,
+        queued_since=queued_since or now_datetime(),
+        priority=priority or "Normal",
+        account_sid=settings.account_sid,
+        rate=settings.messages_per_second or 1,
+    )
+
+    if settings.messaging_service_sid:
+        msg.sender = {"messaging_service_sid": settings.messaging_service_sid.strip()}
+        msg.sender_key = msg.sender["messaging_service_sid"]
+        return msg
+
+    if not normalized:
+        return msg
+
+    pool_sender = get_pool_sender(settings, channel["channel"], normalized)
+
+    if pool_sender:
+        msg.sender = {"from_": with_prefix(channel["prefix"], pool_sender.phone_number)}
+        msg.account_sid = pool_sender.account_sid or settings.account_sid
+        msg.rate = pool_sender.messages_per_second or msg.rate
+    else:
+        msg.sender = {"from_": with_prefix(channel["prefix"], settings.get(channel["number_field"]))}
+
+    msg.sender_key = msg.sender["from_"]
+    return msg
+
+
+def with_prefix(prefix, number):
+    """Add the channel prefix (e.g. "whatsapp:") to a sender number unless it is already there."""
+    number = (number or "").strip()
+    if prefix and not number.startswith(prefix):
+        return prefix + number
+    return number
+
+
+def send_with_backoff(client, bucket, msg, deadline=None):
+    """
+    Send one message through Twilio, retrying with exponential backoff and
+    jitter while Twilio answers 429. A backoff that would run past `deadline`
+    defers the message instead. Runs in a worker thread, so it must not touch
+    frappe.db.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        bucket.acquire()
+        try:
+            twilio_message = client.messages.create(body=msg.body, to=msg.to, **msg.sender)
+            return {"sid": twilio_message.sid}
+
+        except TwilioRestException as e:
+            if e.status == 429 and attempt < MAX_RETRIES:
+                wait = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt) + random.uniform(0, 1)
+                if deadline and time.monotonic() + wait > deadline:
+                    return {"deferred": True}
+                time.sleep(wait)
+                continue
+            return {"error_code": str(e.code or e.status), "error": e.msg, "transient": is_transient_error(e)}
+
+        except Exception as e:
+            return {"error": str(e), "transient": True, "unconfirmed": may_have_been_sent(e)}
+
+
+def record_result(msg, result):
+    """Write the outcome of one send, and how long it waited in the queue, back to its log row."""
+    now = now_datetime()
+
+    if result.get("unconfirmed"):
+        values = {"status": "Unconfirmed", "error_message": f"{UNCONFIRMED_ERROR}: {result.get('error')}"}
+    elif msg.doctype == "WhatsApp Message Log":
+        if result.get("sid"):
+            values = {"message_id": result["sid"], "status": "Sent", "sent_at": now}
+        else:
+            values = {"status": "Failed", "error_message": result.get("error")}
+    else:
+        if result.get("sid"):
+            values = {"message_sid": result["sid"], "date_sent": now}
+        else:
+            values = {"status": "Failed", "error_code": result.get("error_code"), "error_message": result.get("error")}
+
+    values["queue_wait"] = time_diff_in_seconds(now, msg.queued_since)
+    frappe.db.set_value(msg.doctype, msg.name, values)
+
+
+@frappe.whitelist()
+def get_queue_wait_stats(hours=1):
+    """Average and maximum queue wait per channel and priority for messages dispatched in the last `hours`."""
+    frappe.only_for("System Manager")
+
+    since = add_to_date(now_datetime(), hours=-cint(hours))
+    stats = []
+
+    for doctype, channel in CHANNELS.items():
+        table = frappe.qb.DocType(doctype)
+        rows = (
+            frappe.qb.from_(table)
+            .select(
+                table.priority,
+                Count("*").as_("messages"),
+                Avg(table.queue_wait).as_("avg_wait"),
+                Max(table.queue_wait).as_("max_wait"),
+            )
+            .where(table.modified >= since)
+            .where(table.queue_wait.isnotnull())
+            .groupby(table.priority)
+        ).run(as_dict=True)
+
+        stats += [dict(row, channel=channel["channel"]) for row in rows]
+
+    return stats
@@ -90,14 +90,21 @@ import requests
 import json
 from frappe.model.document import Document
 from datetime import datetime, timezone  # Using built-in timezone support
+from tenacious_integration.tenacious_integration import circuit_breaker, transport
+from tenacious_integration.tenacious_integration.settings import get_settings, clear_settings_cache
 
 class AzampaySettings(Document):
-    pass
+    @property
+    def circuit_state(self):
+        return circuit_breaker.describe_circuit("Azampay")
+
+    def on_update(self):
+        clear_settings_cache(self.doctype)
 
 @frappe.whitelist()
 def generate_azampay_token():
     # Fetch single doctype settings
-    doc = frappe.get_single("Azampay Settings")
+    doc = get_settings("Azampay Settings")
 
     # Ensure required fields are present
     if not doc.app_name or not doc.client_id or not doc.client_secret:
@@ -109,8 +116,8 @@ def generate_azampay_token():
     # Payload
     payload = {
         "appName": doc.app_name,
-        "clientId": doc.get_password("client_id"),
-        "clientSecret": doc.get_password("client_secret")
+        "clientId": doc.client_id,
+        "clientSecret": doc.client_secret
     }
     
     headers = {
@@ -119,7 +126,7 @@ def generate_azampay_token():
 
     try:
         # Send request to AzamPay API
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
+        response = transport.request("Azampay", "POST", url, headers=headers, data=json.dumps(payload))
 
         # Log response for debugging
         frappe.logger().info(f"Azampay API Response: {response.text}")
@@ -149,13 +156,13 @@ def generate_azampay_token():
 
         if auth_token:
             # Update fields in the Doctype
-            doc.auth_token = auth_token
-            doc.token_expiry = token_expiry  # Store expiry date in proper format
-            doc.token_status = "Active"
-
-            # Save the Doctype automatically
-            doc.save()
+            frappe.db.set_value("Azampay Settings", None, {
+                "auth_token": auth_token,
+                "token_expiry": token_expiry,  # Store expiry date in proper format
+                "token_status": "Active"
+            })
             frappe.db.commit()  # Ensure changes are committed to the database
+            clear_settings_cache("Azampay Settings")
 
             # Notify user
             frappe.msgprint("Token generated and saved successfully!", alert=True, indicator="green")
@@ -2,6 +2,8 @@ import frappe
 import requests
 import json
 from frappe.model.document import Document
+from tenacious_integration.tenacious_integration import transport
+from tenacious_integration.tenacious_integration.settings import get_settings
 import random
 
 
@@ -33,7 +35,7 @@ def mno_checkout(docname):
         frappe.throw("Transaction already processed. Create a new transaction.")
 
     # Fetch the auth token from Azampay Settings
-    azampay_settings = frappe.get_single("Azampay Settings")
+    azampay_settings = get_settings("Azampay Settings")
     auth_token = azampay_settings.auth_token
 
     if not auth_token:
@@ -58,8 +60,10 @@ def mno_checkout(docname):
     }
 
     try:
-        # Send request to Azampay API
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
+        # Send request to Azampay API; a charge is never retried once it may have reached Azampay
+        response = transport.request(
+            "Azampay", "POST", url, retry_on_status=False, headers=headers, data=json.dumps(payload)
+        )
 
         # Log response for debugging
         frappe.logger().info(f"MNO Checkout API Response: {response.text}")
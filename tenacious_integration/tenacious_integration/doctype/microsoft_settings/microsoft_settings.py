@@ -7,13 +7,31 @@ import requests
 from frappe import _
 from urllib.parse import quote
 from frappe.model.document import Document
+from tenacious_integration.tenacious_integration import circuit_breaker, transport
+from tenacious_integration.tenacious_integration.settings import get_settings, clear_settings_cache
+
+GRAPH_API_BASE_URL = "https://graph.microsoft.com/v1.0"
+LOGIN_BASE_URL = "https://login.microsoftonline.com"
 
 class MicrosoftSettings(Document):
-    pass
+    @property
+    def circuit_state(self):
+        return circuit_breaker.describe_circuit("Microsoft")
+
+    def on_update(self):
+        clear_settings_cache(self.doctype)
+
+def get_graph_url(path):
+    """
+    Microsoft Graph v1.0 URL for `path`. Set `microsoft_graph_base_url` (and
+    `microsoft_login_base_url`) in site config to point the app at a local stub.
+    """
+    return (frappe.conf.get("microsoft_graph_base_url") or GRAPH_API_BASE_URL).rstrip("/") + path
 
 def get_token_endpoint(tenant_id):
     """Generate Microsoft OAuth token endpoint dynamically."""
-    return f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
+    login_base_url = (frappe.conf.get("microsoft_login_base_url") or LOGIN_BASE_URL).rstrip("/")
+    return f"{login_base_url}/{tenant_id}/oauth2/v2.0/token"
 
 def get_authorization_endpoint(tenant_id):
     """Generate Microsoft OAuth authorization endpoint dynamically."""
@@ -22,12 +40,12 @@ def get_authorization_endpoint(tenant_id):
 @frappe.whitelist()
 def authorize_access(code=None):
     """Handle Microsoft OAuth authorization flow and save tokens in Microsoft Settings and One Drive."""
-    ms_settings = frappe.get_single("Microsoft Settings")
+    ms_settings = get_settings("Microsoft Settings")
 
     if not ms_settings.enable:
         frappe.throw(_("Microsoft integration is not enabled."))
 
-    if not ms_settings.client_id or not ms_settings.get_password("client_secret"):
+    if not ms_settings.client_id or not ms_settings.client_secret:
         frappe.throw(_("Please configure Client ID and Client Secret in Microsoft Settings."))
 
     if not ms_settings.tenant_id:
@@ -41,17 +59,18 @@ def authorize_access(code=None):
     if code:
         """ Exchange authorization code for tokens """
         try:
-            token_response = requests.post(
+            token_response = transport.request(
+                "Microsoft",
+                "POST",
                 token_endpoint,
                 data={
                     "client_id": ms_settings.client_id,
-                    "client_secret": ms_settings.get_password("client_secret"),
+                    "client_secret": ms_settings.client_secret,
                     "code": code,
                     "redirect_uri": ms_settings.redirect_uri,
                     "grant_type": "authorization_code",
                 },
                 headers={"Content-Type": "application/x-www-form-urlencoded"},
-                timeout=10,
             )
 
             frappe.logger().info(f"Token response status: {token_response.status_code}")
@@ -112,13 +131,15 @@ def save_tokens(ms_settings, token_data, code):
         frappe.db.set_value("One Drive", None, "refresh_token", token_data["refresh_token"])
 
     frappe.db.commit()
+    clear_settings_cache("Microsoft Settings")
+    clear_settings_cache("One Drive")
     frappe.logger().info("Microsoft tokens saved successfully with correct datetime format.")
 
 
 @frappe.whitelist()
 def refresh_access_token():
     """Refresh the access token using the refresh token."""
-    ms_settings = frappe.get_single("Microsoft Settings")
+    ms_settings = get_settings("Microsoft Settings")
 
     if not ms_settings.refresh_token:
         frappe.throw(_("No refresh token found. Please reauthorize."))
@@ -126,16 +147,17 @@ def refresh_access_token():
     token_endpoint = get_token_endpoint(ms_settings.tenant_id)
 
     try:
-        token_response = requests.post(
+        token_response = transport.request(
+            "Microsoft",
+            "POST",
             token_endpoint,
             data={
                 "client_id": ms_settings.client_id,
-                "client_secret": ms_settings.get_password("client_secret"),
+                "client_secret": ms_settings.client_secret,
                 "refresh_token": ms_settings.refresh_token,
                 "grant_type": "refresh_token",
             },
             headers={"Content-Type": "application/x-www-form-urlencoded"},
-            timeout=10,
         )
 
         frappe.logger().info(f"Token refresh response status: {token_response.status_code}")
@@ -155,7 +177,7 @@ def refresh_access_token():
 @frappe.whitelist()
 def list_files_in_onedrive():
     """List files in the user's OneDrive."""
-    ms_settings = frappe.get_single("Microsoft Settings")
+    ms_settings = get_settings("Microsoft Settings")
     
     if not ms_settings.access_token:
         frappe.throw(_("No access token found. Please authorize first."))
@@ -166,13 +188,14 @@ def list_files_in_onedrive():
     if token_expiry and now_datetime() > token_expiry:
         frappe.logger().info("Access token expired. Refreshing...")
         refresh_access_token()
-        ms_settings = frappe.get_single("Microsoft Settings")
+        ms_settings = get_settings("Microsoft Settings")
 
     try:
-        response = requests.get(
-            "https://graph.microsoft.com/v1.0/me/drive/root/children",
+        response = transport.request(
+            "Microsoft",
+            "GET",
+            get_graph_url("/me/drive/root/children"),
             headers={"Authorization": f"Bearer {ms_settings.access_token}"},
-            timeout=10,
         )
         response.raise_for_status()
         return response.json()
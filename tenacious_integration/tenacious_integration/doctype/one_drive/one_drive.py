@@ -2,19 +2,47 @@ import frappe
 from frappe.model.document import Document
 from frappe.utils.background_jobs import enqueue
 from frappe.utils.backups import new_backup
-from frappe.utils import now_datetime, add_days
+from frappe.utils import now_datetime, add_days, cint, get_datetime
 from frappe import _
+from tenacious_integration.tenacious_integration import backup_stream, file_manifest, transport
+from tenacious_integration.tenacious_integration.circuit_breaker import record_failure, record_success
+from tenacious_integration.tenacious_integration.doctype.microsoft_settings.microsoft_settings import (
+    get_graph_url,
+    get_token_endpoint,
+)
+from tenacious_integration.tenacious_integration.settings import get_settings, clear_settings_cache
 import requests
+import io
 import os
+import threading
+import time
 import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from urllib.parse import quote
+
+MB = 1024 * 1024
+GRAPH_RANGE_UNIT = 320 * 1024  # Graph wants ranges in multiples of 320 KiB
+GRAPH_MAX_RANGE = 60 * MB
+UPLOAD_CHUNK_SIZE = 32 * GRAPH_RANGE_UNIT  # 10 MiB
+UPLOAD_PROGRESS_INTERVAL = 5  # seconds between saves of acknowledged offsets
+UPLOAD_TIMEOUT = (5, 120)  # (connect, read) seconds for one range
+UPLOAD_SESSION_KEY = "tenacious_integration:onedrive_upload_session"
+UPLOAD_SESSION_TTL = 24 * 60 * 60  # seconds, used when Graph does not say when a session expires
+PENDING_BACKUP_KEY = "tenacious_integration:onedrive_pending_backup"
+DEFAULT_COMPRESSION_LEVEL = 3
+MAX_COMPRESSION_LEVEL = 19  # zstd levels above this need --ultra sized windows
+OBJECTS_FOLDER = "objects"  # content-addressed site files of incremental backups, inside the backup folder
+SIMPLE_UPLOAD_LIMIT = 4 * MB  # smaller files go up in one PUT, without an upload session
 
 class OneDrive(Document):
-    pass
+    def on_update(self):
+        clear_settings_cache(self.doctype)
 
 @frappe.whitelist()
 def take_backup():
     """Enqueue a backup task to upload to OneDrive based on frequency settings."""
-    one_drive = frappe.get_single("One Drive")
+    one_drive = get_settings("One Drive")
 
     if not one_drive.enable:
         frappe.throw(_("OneDrive backup is disabled. Enable it."))
@@ -55,38 +83,53 @@ def is_backup_due(one_drive):
 def upload_backup_to_onedrive():
     """Perform the backup and upload to OneDrive, ensuring error handling for RQ Jobs."""
     try:
-        ms_settings = frappe.get_single("Microsoft Settings")
-        one_drive = frappe.get_single("One Drive")
+        ms_settings = get_settings("Microsoft Settings")
+        one_drive = get_settings("One Drive")
 
         if not ms_settings.refresh_token:
             raise Exception(_("Microsoft account is not authorized. Please authorize in Microsoft Settings."))
 
-        access_token = refresh_access_token(ms_settings)
+        #  Shared by every Graph call of the run, so an expired token is refreshed once
+        token = GraphToken(refresh_access_token(ms_settings))
 
         #  Ensure backup folder exists
-        folder_id = ensure_onedrive_folder_exists(access_token, one_drive)
+        folder_id = ensure_onedrive_folder_exists(token.value, one_drive)
 
         # Save folder ID if new
         if folder_id and folder_id != one_drive.backup_folder_id:
             frappe.db.set_value("One Drive", None, "backup_folder_id", folder_id)
             frappe.db.commit()
+            clear_settings_cache("One Drive")
 
-        #  Generate a new backup
-        backup = new_backup()
-        backup_files = [backup.backup_path_db, backup.backup_path_conf]
+        #  Finish the files of a run that failed or was killed, otherwise generate a new backup
+        backup_files = frappe.cache().get_value(PENDING_BACKUP_KEY)
 
-        if one_drive.file_backup:
-            backup_files.extend([backup.backup_path_files, backup.backup_path_private_files])
+        incremental = one_drive.file_backup and one_drive.incremental_file_backup
 
-        #  Upload files to OneDrive
-        for file_path in backup_files:
-            if file_path:
-                upload_to_onedrive(access_token, file_path, folder_id)
+        if not backup_files or not all(os.path.exists(f) for f in backup_files):
+            backup = new_backup(ignore_files=bool(incremental))
+            backup_files = [backup.backup_path_db, backup.backup_path_conf]
+
+            if one_drive.file_backup and not incremental:
+                backup_files.extend([backup.backup_path_files, backup.backup_path_private_files])
+
+            backup_files = [f for f in backup_files if f]
+            frappe.cache().set_value(PENDING_BACKUP_KEY, backup_files, expires_in_sec=UPLOAD_SESSION_TTL)
+
+        #  Upload new site file contents first, so the run manifest never points at missing objects
+        if incremental:
+            backup_files = backup_files + [upload_files_incrementally(token, one_drive, folder_id)]
+
+        #  Upload files to OneDrive, several at a time
+        upload_files_to_onedrive(token, backup_files, folder_id)
+
+        frappe.cache().delete_value(PENDING_BACKUP_KEY)
 
         #  Update last backup time and status
         frappe.db.set_value("One Drive", None, "last_backup_on", now_datetime())
         frappe.db.set_value("One Drive", None, "last_backup_status", "Success")  
         frappe.db.commit()
+        clear_settings_cache("One Drive")
 
         # Send email notification if enabled
         if one_drive.send_email_for_successful_backup and one_drive.email:
@@ -102,45 +145,556 @@ def upload_backup_to_onedrive():
         # Store error message in a separate field (not last_backup_on)
         frappe.db.set_value("One Drive", None, "last_backup_status", error_message)
         frappe.db.commit()
+        clear_settings_cache("One Drive")
 
         # Properly fail the RQ job (this will make it show as failed in UI)
         raise frappe.ValidationError(error_message)
 
-def upload_to_onedrive(access_token, file_path, folder_id):
-    """Upload a file to OneDrive inside the specified folder."""
-    headers = {"Authorization": f"Bearer {access_token}"}
-    file_name = os.path.basename(file_path)
+class UploadError(Exception):
+    """A range upload Graph refused. Raised in worker threads, so it carries no translated text."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+class ByteBudget:
+    """Thread-safe cap on the bytes that all upload workers together hold in memory."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        """Block until `size` more bytes fit; a range larger than the whole budget waits until it is alone."""
+        with self.condition:
+            while self.used and self.used + size > self.limit:
+                self.condition.wait()
+            self.used += size
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+class GraphToken:
+    """
+    The Graph access token of a backup run. Requests read it from here, so once
+    it expires it is refreshed a single time and every later request uses the
+    new one. Refreshing writes Microsoft Settings, so only the main thread does.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    @classmethod
+    def of(cls, token):
+        return token if isinstance(token, cls) else cls(token)
+
+    def headers(self, **headers):
+        return {"Authorization": f"Bearer {self.value}", **headers}
+
+    def refresh(self):
+        frappe.logger().warning("Access token expired. Refreshing it...")
+        self.value = refresh_access_token(get_settings("Microsoft Settings"))
+
+    def request(self, method, url, headers=None, **kwargs):
+        """A Graph call, repeated once with a refreshed token if Graph answers 401."""
+        response = transport.request("Microsoft", method, url, headers=self.headers(**(headers or {})), **kwargs)
+        if response.status_code == 401:
+            self.refresh()
+            response = transport.request("Microsoft", method, url, headers=self.headers(**(headers or {})), **kwargs)
+        return response
+
+def upload_files_incrementally(token, one_drive, folder_id):
+    """
+    Upload the public and private file contents OneDrive does not have yet to
+    the objects folder, each once and named by its SHA-256, and return the path
+    of this run's manifest, which a restore uses to put every file back (see
+    file_manifest.restore_files). Objects that made it up are recorded even
+    when others fail, so the next run only retries the rest. A file changed
+    since the scan may have been uploaded with other content than its hash, so
+    its object is not recorded and the file waits for the next run.
+    """
+    manifest = file_manifest.load_local_manifest(folder_id)
+    manifest["files"] = file_manifest.scan_files(manifest["files"], max(cint(one_drive.upload_workers), 1))
+    # Keep the hashes even if the upload fails, so the next run does not compute them again
+    file_manifest.save_local_manifest(manifest)
+
+    sources, small, large = {}, {}, {}
+    for path, (size, _mtime, digest) in manifest["files"].items():
+        if digest not in manifest["objects"] and digest not in sources:
+            sources[digest] = path
+            (small if size < SIMPLE_UPLOAD_LIMIT else large)[digest] = frappe.get_site_path(path)
+
+    uploaded, errors = [], []
+    try:
+        if small or large:
+            objects_folder_id = ensure_onedrive_subfolder(token, folder_id, OBJECTS_FOLDER)
+
+        # Most attachments are small: one PUT each, without the round trips of an upload session
+        if small:
+            uploaded, errors = upload_small_files(token, one_drive, small, objects_folder_id)
+
+        if large:
+            completed = []
+            try:
+                upload_files_to_onedrive(
+                    token,
+                    list(large.values()),
+                    objects_folder_id,
+                    remote_names={file_path: digest for digest, file_path in large.items()},
+                    inflate=False,
+                    completed=completed,
+                )
+            finally:
+                uploaded += [digest for digest, file_path in large.items() if file_path in completed]
+    finally:
+        changed = {
+            digest
+            for digest in uploaded
+            if not file_manifest.is_unchanged(sources[digest], manifest["files"][sources[digest]])
+        }
+        if changed:
+            # Leave these files out of the run manifest and the hash cache, so the next run hashes them again
+            frappe.logger().warning(f"{len(changed)} files changed while uploading. The next backup run uploads them.")
+            manifest["files"] = {path: entry for path, entry in manifest["files"].items() if entry[2] not in changed}
+        if uploaded:
+            manifest["objects"].update(set(uploaded) - changed)
+            file_manifest.save_local_manifest(manifest)
+
+    if errors:
+        frappe.throw(_("Failed to upload {0} files to OneDrive. The next backup run retries them.").format(len(errors)))
+
+    frappe.logger().info(
+        f"Incremental file backup: {len(manifest['files'])} files, {len(uploaded)} new objects uploaded"
+    )
+    return file_manifest.write_run_manifest(manifest["files"])
+
+def upload_small_files(token, one_drive, files, folder_id):
+    """
+    Upload files under SIMPLE_UPLOAD_LIMIT with a single PUT each, several at a
+    time, encoding each in memory when compression is on. `files` maps OneDrive
+    names to paths. Files refused with 401 are put again once with a refreshed
+    token. Returns the names uploaded and the names that failed.
+    """
+    workers = max(cint(one_drive.upload_workers), 1)
+    encoding = get_backup_encoding(one_drive)
+    passphrase = encoding.passphrase if encoding else None
+    retries = transport.get_retries()
+
+    # URLs and parameters are built here, since worker threads cannot read site config
+    jobs = []
+    for name, file_path in files.items():
+        params = backup_stream.new_params(encoding.level, bool(passphrase), inflate=False) if encoding else None
+        remote_name = backup_stream.encoded_name(name, params) if params else name
+        url = get_graph_url(
+            f"/me/drive/items/{folder_id}:/{quote(remote_name)}:/content?@microsoft.graph.conflictBehavior=replace"
+        )
+        jobs.append((name, file_path, params, url))
+
+    http_session = transport.get_session(jobs[0][3])
+
+    def put_files(jobs):
+        headers = token.headers(**{"Content-Type": "application/octet-stream"})
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(put_small_file, http_session, url, file_path, params, passphrase, headers, retries): name
+                for name, file_path, params, url in jobs
+            }
+        return {name: future.exception() for future, name in futures.items()}
+
+    outcomes = put_files(jobs)
+    expired = [job for job in jobs if getattr(outcomes[job[0]], "status_code", None) == 401]
+    if expired:
+        token.refresh()
+        outcomes.update(put_files(expired))
+
+    uploaded, errors, transient = [], [], False
+    for name, error in outcomes.items():
+        if error:
+            transient = transient or isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+            frappe.logger().error(f"Failed to upload {files[name]} as {name}: {error}")
+            errors.append(name)
+        else:
+            uploaded.append(name)
+
+    if transient:
+        record_failure("Microsoft")
+    else:
+        record_success("Microsoft")
+
+    return uploaded, errors
 
-    upload_url = f"https://graph.microsoft.com/v1.0/me/drive/items/{folder_id}:/{file_name}:/content"
-    with open(file_path, "rb") as file_data:
-        try:
-            response = requests.put(upload_url, headers=headers, data=file_data, timeout=60)
-        except requests.exceptions.Timeout:
-            frappe.logger().error(f"Timeout while uploading {file_name}. Retrying...")
-            frappe.throw(_("Upload to OneDrive timed out. Please try again."))
-
-    if response.status_code in (200, 201):
-        frappe.logger().info(f"File uploaded successfully: {file_name}")
-    elif response.status_code == 401:
-        frappe.logger().warning(f"⚠️ Access token expired. Retrying upload after refreshing token...")
-        access_token = refresh_access_token(frappe.get_single("Microsoft Settings"))
-        upload_to_onedrive(access_token, file_path, folder_id)  # Retry upload
+def put_small_file(http_session, url, file_path, params, passphrase, headers, retries):
+    """Upload one small file, encoded in memory when `params` are given. Runs in a worker thread."""
+    if params:
+        data = b"".join(backup_stream.encode(file_path, params, passphrase))
     else:
-        frappe.logger().error(f"Failed to upload {file_name}. Response: {response.text}")
-        frappe.throw(_("Failed to upload file {0} to OneDrive.").format(file_name))
+        with open(file_path, "rb") as f:
+            data = f.read()
+
+    response = transport.send(http_session, "PUT", url, retries, headers=headers, data=data, timeout=UPLOAD_TIMEOUT)
+    if response.status_code not in (200, 201):
+        raise UploadError(f"HTTP {response.status_code}: {response.text}", response.status_code)
+
+def upload_to_onedrive(token, file_path, folder_id):
+    """Upload a single file to OneDrive inside the specified folder. See upload_files_to_onedrive."""
+    return upload_files_to_onedrive(token, [file_path], folder_id)
+
+def upload_files_to_onedrive(token, file_paths, folder_id, remote_names=None, inflate=True, completed=None):
+    """
+    Upload files to OneDrive inside the specified folder through Graph upload
+    sessions, several files at a time (Upload Workers in One Drive). Each file
+    is streamed in fixed-size ranges, in order as Graph requires, and the
+    ranges in flight across all workers never exceed Max In-Flight Upload.
+    Sessions and acknowledged offsets are kept in Redis, so a later run picks
+    every unfinished file up where it stopped. Returns the transfer statistics,
+    which are also logged, so throughput can be compared against a local Graph stub.
+    With Compress Backups on, files are streamed through zstd (and AES-GCM when
+    Encrypt Backups is on) straight into the session; see backup_stream.
+    `remote_names` maps file paths to OneDrive names other than their own, and
+    `inflate` turns off the inflating of gzipped files before compression.
+    `completed`, when given, collects the paths that finished, also when
+    others fail. `token` is a GraphToken or an access token string.
+    """
+    one_drive = get_settings("One Drive")
+    workers = max(cint(one_drive.upload_workers), 1)
+    chunk_size = get_chunk_size(one_drive)
+    budget = ByteBudget(max(cint(one_drive.max_in_flight_upload), 1) * MB)
+    retries = transport.get_retries()
+    encoding = get_backup_encoding(one_drive)
+
+    # Sessions are started or resumed here, since worker threads cannot use frappe.cache
+    uploads = prepare_uploads(
+        GraphToken.of(token), file_paths, folder_id, encoding, workers, remote_names or {}, inflate, chunk_size, budget.limit
+    )
+    pending = [upload for upload in uploads if not upload.item]
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(
+                upload_ranges,
+                transport.get_session(upload.session["upload_url"]),
+                upload,
+                chunk_size,
+                budget,
+                retries,
+            ): upload
+            for upload in pending
+        }
+
+        # Persist acknowledged offsets while the workers run, so a killed job can resume
+        running = set(futures)
+        while running:
+            _done, running = wait(running, timeout=UPLOAD_PROGRESS_INTERVAL, return_when=FIRST_COMPLETED)
+            for upload in pending:
+                if upload.session["offset"] != upload.offset:
+                    upload.session["offset"] = upload.offset
+                    save_upload_session(upload.file_path, upload.session)
+
+    if completed is not None:
+        completed.extend(upload.file_path for upload in uploads if upload.item)
+
+    errors, transient = [], False
+    for future, upload in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            transient = transient or isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+            if getattr(e, "status_code", None) in (404, 410):
+                clear_upload_session(upload.file_path)
+            frappe.logger().error(f"Failed to upload {upload.file_name} at byte {upload.offset}: {e}")
+            errors.append(upload.file_name)
+        else:
+            clear_upload_session(upload.file_path)
+            frappe.logger().info(f"File uploaded successfully: {upload.file_name}")
+            if completed is not None:
+                completed.append(upload.file_path)
+
+    if pending:
+        if transient:
+            record_failure("Microsoft")
+        else:
+            record_success("Microsoft")
+
+    elapsed = time.monotonic() - started
+    sent = sum(upload.sent for upload in uploads)
+    stats = {
+        "files": len(uploads),
+        "bytes": sent,
+        "seconds": round(elapsed, 2),
+        "mb_per_second": round(sent / MB / elapsed, 2) if elapsed else None,
+        "workers": workers,
+        "chunk_size": chunk_size,
+        "compression_level": encoding.level if encoding else None,
+    }
+    frappe.logger().info(f"OneDrive upload: {stats}")
+
+    if errors:
+        frappe.throw(_("Failed to upload {0} to OneDrive. The next backup run resumes them.").format(", ".join(errors)))
+
+    return stats
+
+def get_chunk_size(one_drive):
+    """Upload Chunk Size from One Drive, in the multiples of 320 KiB that Graph accepts, up to its 60 MiB limit."""
+    chunk_size = cint(one_drive.upload_chunk_size) * MB or UPLOAD_CHUNK_SIZE
+    return min(max(chunk_size // GRAPH_RANGE_UNIT, 1), GRAPH_MAX_RANGE // GRAPH_RANGE_UNIT) * GRAPH_RANGE_UNIT
+
+def get_backup_encoding(one_drive):
+    """How backups are encoded on the way up: None to upload them as they are, or the zstd level and passphrase."""
+    if not one_drive.compress_backups:
+        return None
+
+    if not backup_stream.zstandard:
+        frappe.throw(_("Install the zstandard package to compress backups, or turn off Compress Backups."))
+
+    passphrase = None
+    if one_drive.encrypt_backups:
+        passphrase = one_drive.encryption_passphrase
+        if not passphrase:
+            frappe.throw(_("Set an Encryption Passphrase in One Drive, or turn off Encrypt Backups."))
+
+    level = cint(one_drive.compression_level) or DEFAULT_COMPRESSION_LEVEL
+    return frappe._dict(level=min(max(level, 1), MAX_COMPRESSION_LEVEL), passphrase=passphrase)
+
+def prepare_uploads(
+    token, file_paths, folder_id, encoding, workers, remote_names, inflate, chunk_size, buffer_limit
+):
+    """
+    Resume the stored upload session of each file, or start a new one. Encoded
+    streams that fit in one range are kept in memory, up to `buffer_limit`
+    bytes in all, so they are compressed once rather than measured and then
+    compressed again.
+    """
+    uploads = []
+    for file_path in file_paths:
+        session = get_upload_session(file_path, encoding, inflate)
+        offset = get_next_offset(session) if session else None
+        if offset is not None:
+            frappe.logger().info(f"Resuming upload of {session['name']} at byte {offset}")
+
+        uploads.append(frappe._dict(
+            file_path=file_path,
+            session=session if offset is not None else None,
+            offset=offset or 0,
+            passphrase=encoding.passphrase if encoding else None,
+            data=None,
+            sent=0,
+            item=None,
+        ))
+
+    # Graph needs the size of a new upload up front; measuring an encoded stream
+    # means compressing it once, so those passes run side by side
+    new = [upload for upload in uploads if not upload.session]
+    params = [
+        backup_stream.new_params(encoding.level, bool(encoding.passphrase), inflate) if encoding else None
+        for _upload in new
+    ]
+    kept = buffer_limit // chunk_size
+    keep_limits = [chunk_size if i < kept else 0 for i in range(len(new))]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        measured = list(
+            pool.map(
+                get_upload_size,
+                [upload.file_path for upload in new],
+                params,
+                [upload.passphrase for upload in new],
+                keep_limits,
+            )
+        )
+
+    for upload, upload_params, (size, data) in zip(new, params, measured):
+        upload.data = data
+        upload.session = create_upload_session(
+            token, folder_id, upload.file_path, size, upload_params, remote_names.get(upload.file_path)
+        )
+
+    for upload in uploads:
+        upload.file_name = upload.session["name"]
+        upload.file_size = upload.session["size"]
+
+    return uploads
+
+def get_upload_size(file_path, params, passphrase, keep_limit):
+    """
+    Bytes that will be uploaded for the file, and the encoded bytes themselves
+    when they fit in `keep_limit`. Runs in a worker thread.
+    """
+    if params:
+        return backup_stream.measure(file_path, params, passphrase, keep_limit)
+    return os.path.getsize(file_path), None
+
+def open_upload_source(upload):
+    """
+    The bytes to upload: the encoded stream kept from measuring it, the
+    stream encoded again when the session has encoding parameters, else the file itself.
+    """
+    if upload.data is not None:
+        return io.BytesIO(upload.data)
+
+    params = upload.session.get("encoding")
+    if params:
+        return backup_stream.EncodedFile(upload.file_path, params, upload.passphrase)
+    return open(upload.file_path, "rb")
+
+def upload_ranges(http_session, upload, chunk_size, budget, retries):
+    """
+    Send the remaining ranges of one file in order. Runs in a worker thread, so
+    it must not touch frappe.db or frappe.cache: progress is left on `upload`
+    for the main thread to persist.
+    """
+    upload_url = upload.session["upload_url"]
+
+    with open_upload_source(upload) as file_data:
+        while True:
+            size = min(chunk_size, upload.file_size - upload.offset)
+            budget.acquire(size)
+            try:
+                file_data.seek(upload.offset)
+                chunk = file_data.read(size)
+
+                # The upload URL is pre-authenticated: it must not carry the access token
+                response = transport.send(
+                    http_session,
+                    "PUT",
+                    upload_url,
+                    retries,
+                    headers={"Content-Range": f"bytes {upload.offset}-{upload.offset + size - 1}/{upload.file_size}"},
+                    data=chunk,
+                    timeout=UPLOAD_TIMEOUT,
+                )
+            finally:
+                chunk = None
+                budget.release(size)
+
+            if response.status_code in (200, 201):
+                upload.sent += size
+                upload.item = response.json()
+                return
+
+            # A range Graph already has (its acknowledgement was lost): ask where to carry on
+            if response.status_code == 416:
+                status = transport.send(http_session, "GET", upload_url, retries, timeout=UPLOAD_TIMEOUT)
+                if status.status_code == 200:
+                    next_offset = get_offset_from_ranges(status.json().get("nextExpectedRanges"))
+                    if next_offset != upload.offset:
+                        upload.offset = next_offset
+                        continue
+
+            if response.status_code != 202:
+                raise UploadError(f"HTTP {response.status_code}: {response.text}", response.status_code)
+
+            upload.sent += size
+            upload.offset = get_offset_from_ranges(response.json().get("nextExpectedRanges"))
+
+def create_upload_session(token, folder_id, file_path, file_size, params=None, file_name=None):
+    """
+    Start a Graph upload session for the file, refreshing the run's GraphToken
+    if it has expired. `params` are the backup_stream parameters when the file
+    is uploaded encoded, in which case `file_size` is the encoded size.
+    `file_name` is the OneDrive name, by default the file's own.
+    """
+    file_name = file_name or os.path.basename(file_path)
+    if params:
+        file_name = backup_stream.encoded_name(file_name, params)
+    url = get_graph_url(f"/me/drive/items/{folder_id}:/{quote(file_name)}:/createUploadSession")
+    payload = {"item": {"@microsoft.graph.conflictBehavior": "replace"}}
+
+    response = token.request("POST", url, json=payload)
+    if response.status_code != 200:
+        frappe.logger().error(f"Failed to create upload session for {file_name}. Response: {response.text}")
+        frappe.throw(_("Failed to start uploading file {0} to OneDrive.").format(file_name))
+
+    data = response.json()
+    session = {
+        "upload_url": data["uploadUrl"],
+        "expires": data.get("expirationDateTime"),
+        "name": file_name,
+        "size": file_size,
+        "source_size": os.path.getsize(file_path),
+        "mtime": os.path.getmtime(file_path),
+        "encoding": params,
+        "offset": 0,
+    }
+    save_upload_session(file_path, session)
+    return session
+
+def get_upload_session(file_path, encoding, inflate=True):
+    """
+    The stored upload session of a file, unless the file changed since it was
+    started or it would now be encoded differently: a resumed encoded upload
+    must produce the very bytes Graph already has.
+    """
+    session = frappe.cache().get_value(f"{UPLOAD_SESSION_KEY}:{file_path}")
+    if not session or "source_size" not in session:
+        return None
+
+    stat = os.stat(file_path)
+    if session["source_size"] != stat.st_size or session["mtime"] != stat.st_mtime:
+        return None
+
+    params = session["encoding"]
+    if not encoding:
+        return None if params else session
+
+    if (
+        params
+        and params["level"] == encoding.level
+        and params.get("inflate") == inflate
+        and bool(params["salt"]) == bool(encoding.passphrase)
+        and params["zstd"] == backup_stream.zstandard.__version__
+    ):
+        return session
+
+def save_upload_session(file_path, session):
+    """Store the session until Graph expires it."""
+    expires_in = UPLOAD_SESSION_TTL
+    if session.get("expires"):
+        expires_in = frappe.utils.time_diff_in_seconds(
+            get_datetime(session["expires"]).replace(tzinfo=None), datetime.utcnow()
+        )
+
+    if expires_in > 0:
+        frappe.cache().set_value(f"{UPLOAD_SESSION_KEY}:{file_path}", session, expires_in_sec=int(expires_in))
+
+def clear_upload_session(file_path):
+    frappe.cache().delete_value(f"{UPLOAD_SESSION_KEY}:{file_path}")
+
+def get_next_offset(session):
+    """
+    Ask Graph where an upload session stands, falling back to the last
+    acknowledged offset. Returns None when the session no longer exists.
+    """
+    try:
+        response = transport.request("Microsoft", "GET", session["upload_url"])
+    except requests.exceptions.RequestException:
+        return session["offset"]
+
+    if response.status_code == 200:
+        return get_offset_from_ranges(response.json().get("nextExpectedRanges"))
+    if response.status_code in (404, 410):
+        return None
+    return session["offset"]
+
+def get_offset_from_ranges(ranges):
+    """First missing byte from Graph's nextExpectedRanges, e.g. ["26214400-"]."""
+    return int(ranges[0].split("-")[0]) if ranges else 0
 
 def refresh_access_token(ms_settings):
     """Refresh the access token using the refresh token."""
-    response = requests.post(
-        f"https://login.microsoftonline.com/{ms_settings.tenant_id}/oauth2/v2.0/token",
+    response = transport.request(
+        "Microsoft",
+        "POST",
+        get_token_endpoint(ms_settings.tenant_id),
         data={
             "client_id": ms_settings.client_id,
-            "client_secret": ms_settings.get_password("client_secret"),
+            "client_secret": ms_settings.client_secret,
             "refresh_token": ms_settings.refresh_token,
             "grant_type": "refresh_token",
         },
         headers={"Content-Type": "application/x-www-form-urlencoded"},
-        timeout=15,
     ).json()
 
     if "access_token" in response:
@@ -151,6 +705,7 @@ def refresh_access_token(ms_settings):
             frappe.db.set_value("Microsoft Settings", None, "refresh_token", response["refresh_token"])
 
         frappe.db.commit()
+        clear_settings_cache("Microsoft Settings")
         return response["access_token"]
     
     else:
@@ -162,18 +717,19 @@ def ensure_onedrive_folder_exists(access_token, one_drive):
     headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
 
     try:
-        search_url = f"https://graph.microsoft.com/v1.0/me/drive/root/children?$filter=name eq '{folder_name}'"
-        search_response = requests.get(search_url, headers=headers, timeout=15).json()
+        search_url = get_graph_url(f"/me/drive/root/children?$filter=name eq '{folder_name}'")
+        search_response = transport.request("Microsoft", "GET", search_url, headers=headers).json()
 
         if "value" in search_response and search_response["value"]:
             return search_response["value"][0]["id"]
 
-        create_url = "https://graph.microsoft.com/v1.0/me/drive/root/children"
-        create_response = requests.post(
+        create_url = get_graph_url("/me/drive/root/children")
+        create_response = transport.request(
+            "Microsoft",
+            "POST",
             create_url,
             headers=headers,
             json={"name": folder_name, "folder": {}, "@microsoft.graph.conflictBehavior": "rename"},
-            timeout=15,
         ).json()
 
         if "id" in create_response:
@@ -187,6 +743,24 @@ def ensure_onedrive_folder_exists(access_token, one_drive):
     except requests.exceptions.RequestException as re:
         raise Exception(f"OneDrive API Request Failed: {str(re)}")
 
+def ensure_onedrive_subfolder(token, parent_id, folder_name):
+    """ID of the named folder inside the parent folder, created if missing. `token` is a GraphToken."""
+    response = token.request("GET", get_graph_url(f"/me/drive/items/{parent_id}:/{quote(folder_name)}"))
+    if response.status_code == 200:
+        return response.json()["id"]
+
+    if response.status_code == 404:
+        response = token.request(
+            "POST",
+            get_graph_url(f"/me/drive/items/{parent_id}/children"),
+            json={"name": folder_name, "folder": {}, "@microsoft.graph.conflictBehavior": "fail"},
+        )
+        if response.status_code in (200, 201):
+            return response.json()["id"]
+
+    frappe.logger().error(f"Failed to open OneDrive folder {folder_name}. Response: {response.text}")
+    frappe.throw(_("Failed to open the {0} folder on OneDrive.").format(folder_name))
+
 def send_backup_email(email, backup_files):
     """Send an email notification after a successful backup."""
     user_full_name = frappe.db.get_value("User", frappe.session.user, "full_name") or "User"
@@ -1,9 +1,143 @@
 # Copyright (c) 2025, Joshua Joseph Michael and Contributors
 # See license.txt
 
-# import frappe
+import gzip
+import io
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from frappe.tests.utils import FrappeTestCase
 
+from tenacious_integration.tenacious_integration import backup_stream
+from tenacious_integration.tenacious_integration.backup_stream import (
+	FRAME_SIZE,
+	HEADER_SIZE,
+	MAGIC,
+	SALT_SIZE,
+	TAG_SIZE,
+)
+
+PASSPHRASE = "correct horse battery staple"
 
+
+@unittest.skipUnless(backup_stream.zstandard, "zstandard is not installed")
 class TestOneDrive(FrappeTestCase):
-	pass
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		# Incompressible bytes, so the compressed stream spans more than one encryption frame
+		self.content = os.urandom(FRAME_SIZE + 12345) + b"backup " * 50000
+		self.source = self.write("backup.sql", self.content)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def write(self, name, data):
+		path = os.path.join(self.tmp, name)
+		with open(path, "wb") as f:
+			f.write(data)
+		return path
+
+	def encode_to_file(self, source, params, passphrase=None):
+		path = os.path.join(self.tmp, backup_stream.encoded_name(os.path.basename(source), params))
+		with open(path, "wb") as f:
+			for chunk in backup_stream.encode(source, params, passphrase):
+				f.write(chunk)
+		return path
+
+	def decode(self, path, passphrase=None):
+		output = os.path.join(self.tmp, "decoded")
+		backup_stream.decode_backup(path, output, passphrase)
+		with open(output, "rb") as f:
+			return f.read()
+
+	def test_round_trip(self):
+		for encrypt in (False, True):
+			with self.subTest(encrypt=encrypt):
+				params = backup_stream.new_params(3, encrypt)
+				passphrase = PASSPHRASE if encrypt else None
+				encoded = self.encode_to_file(self.source, params, passphrase)
+
+				self.assertEqual(os.path.getsize(encoded), backup_stream.encoded_size(self.source, params))
+				self.assertEqual(self.decode(encoded, passphrase), self.content)
+
+	def test_encoding_is_deterministic(self):
+		params = backup_stream.new_params(3, True)
+		first = b"".join(backup_stream.encode(self.source, params, PASSPHRASE))
+		second = b"".join(backup_stream.encode(self.source, params, PASSPHRASE))
+		self.assertEqual(first, second)
+
+	def test_measure_keeps_small_streams(self):
+		for encrypt in (False, True):
+			with self.subTest(encrypt=encrypt):
+				params = backup_stream.new_params(3, encrypt)
+				passphrase = PASSPHRASE if encrypt else None
+				encoded = b"".join(backup_stream.encode(self.source, params, passphrase))
+
+				self.assertEqual(backup_stream.measure(self.source, params, passphrase, len(encoded)), (len(encoded), encoded))
+				self.assertEqual(backup_stream.measure(self.source, params, passphrase, len(encoded) - 1), (len(encoded), None))
+
+	def test_frame_boundaries(self):
+		salt, nonce_prefix = os.urandom(SALT_SIZE), os.urandom(8)
+		key = backup_stream.derive_key(PASSPHRASE, salt)
+
+		for size in (0, 1, FRAME_SIZE - 1, FRAME_SIZE, FRAME_SIZE + 1, 2 * FRAME_SIZE):
+			with self.subTest(size=size):
+				plaintext = os.urandom(size)
+				# Uneven chunks, so frames are cut across chunk boundaries
+				chunks = [plaintext[i : i + 300000] for i in range(0, size, 300000)]
+				sealed = b"".join(backup_stream.encrypt(chunks, key, salt, nonce_prefix))
+
+				frames = max(math.ceil(size / FRAME_SIZE), 1)
+				self.assertEqual(len(sealed), HEADER_SIZE + size + TAG_SIZE * frames)
+				self.assertTrue(sealed.startswith(MAGIC + salt + nonce_prefix))
+
+				decrypted = backup_stream.decrypt(io.BytesIO(sealed[HEADER_SIZE:]), AESGCM(key), nonce_prefix)
+				self.assertEqual(b"".join(decrypted), plaintext)
+
+	def test_truncated_or_wrong_key_fails(self):
+		params = backup_stream.new_params(3, True)
+		encoded = self.encode_to_file(self.source, params, PASSPHRASE)
+
+		with open(encoded, "rb") as f:
+			data = f.read()
+		# Cut exactly after the first frame: without the sealed last frame the rest must not decrypt
+		truncated = self.write("truncated.zst.enc", data[: HEADER_SIZE + FRAME_SIZE + TAG_SIZE])
+
+		self.assertRaises(InvalidTag, self.decode, truncated, PASSPHRASE)
+		self.assertRaises(InvalidTag, self.decode, encoded, "wrong passphrase")
+		self.assertRaises(ValueError, self.decode, encoded, None)
+
+	def test_encoded_file_ranges(self):
+		params = backup_stream.new_params(3, True)
+		encoded = b"".join(backup_stream.encode(self.source, params, PASSPHRASE))
+		range_size = 320 * 1024
+
+		with backup_stream.EncodedFile(self.source, params, PASSPHRASE) as f:
+			ranges = []
+			while chunk := f.read(range_size):
+				ranges.append(chunk)
+			self.assertEqual(b"".join(ranges), encoded)
+
+			# A resumed upload seeks to the acknowledged offset, backwards if need be
+			f.seek(range_size)
+			self.assertEqual(f.read(range_size), encoded[range_size : 2 * range_size])
+
+	def test_gzipped_sources(self):
+		source = self.write("site-database.sql.gz", gzip.compress(self.content))
+
+		inflated = backup_stream.new_params(3, False)
+		encoded = self.encode_to_file(source, inflated)
+		self.assertTrue(encoded.endswith("site-database.sql.zst"))
+		self.assertEqual(self.decode(encoded), self.content)
+
+		# Site files are stored as they are, so they decode to their own hash
+		as_is = backup_stream.new_params(3, False, inflate=False)
+		encoded = self.encode_to_file(source, as_is)
+		self.assertTrue(encoded.endswith("site-database.sql.gz.zst"))
+		with open(source, "rb") as f:
+			self.assertEqual(self.decode(encoded), f.read())
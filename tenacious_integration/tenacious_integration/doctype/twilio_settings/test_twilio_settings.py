@@ -1,9 +1,112 @@
 # Copyright (c) 2025, Joshua Joseph Michael and Contributors
 # See license.txt
 
-# import frappe
+import json
+import time
+from hashlib import sha256
+from unittest.mock import MagicMock
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import get_url
+from twilio.request_validator import RequestValidator
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from tenacious_integration.tenacious_integration.dispatcher import get_bucket
+from tenacious_integration.tenacious_integration.phone import normalize_phone_number
+from tenacious_integration.tenacious_integration.twilio_client import (
+	TWILIO_TIMEOUT,
+	clear_twilio_clients,
+	get_twilio_client,
+	is_valid_twilio_request,
+)
 
 
 class TestTwilioSettings(FrappeTestCase):
-	pass
+	def tearDown(self):
+		clear_twilio_clients()
+
+	def test_get_twilio_client(self):
+		settings = frappe._dict(account_sid="AC" + "0" * 32, auth_token="token", modified="2025-01-01")
+		client = get_twilio_client(settings)
+
+		self.assertIsNotNone(client)
+		self.assertIs(get_twilio_client(settings), client)
+
+		# Calls carry the (connect, read) timeout through to requests
+		http_client = client.http_client
+		http_client.session.send = MagicMock(return_value=MagicMock(status_code=200, text="{}", headers={}))
+		http_client.request("GET", "https://api.twilio.com/2010-04-01/Accounts.json")
+		self.assertEqual(http_client.session.send.call_args.kwargs["timeout"], TWILIO_TIMEOUT)
+
+	def test_get_twilio_client_without_credentials(self):
+		self.assertIsNone(get_twilio_client(frappe._dict(account_sid=None, auth_token=None)))
+
+	def test_is_valid_twilio_request(self):
+		self.addCleanup(setattr, frappe.local, "request", getattr(frappe.local, "request", None))
+		settings = frappe._dict(auth_token="token", validate_webhook_signatures=0)
+		body = json.dumps({"MessageSid": "SM123", "MessageStatus": "delivered"})
+		path = "/api/method/tenacious_integration.tenacious_integration.api.twilio_sms_webhook"
+		query = f"bodySHA256={sha256(body.encode()).hexdigest()}"
+		signature = RequestValidator("token").compute_signature(f"{get_url(path)}?{query}", {})
+
+		def set_request(data, signature=None, query_string=query):
+			headers = {"X-Twilio-Signature": signature} if signature else {}
+			environ = EnvironBuilder(
+				path=path, query_string=query_string, method="POST", data=data, content_type="application/json", headers=headers
+			).get_environ()
+			frappe.local.request = Request(environ)
+
+		# Unsigned calls pass until validation is turned on
+		set_request(body)
+		self.assertTrue(is_valid_twilio_request(settings))
+
+		settings.validate_webhook_signatures = 1
+		self.assertFalse(is_valid_twilio_request(settings))
+
+		set_request(body, signature)
+		self.assertTrue(is_valid_twilio_request(settings))
+
+		set_request(body.replace("delivered", "read"), signature)
+		self.assertFalse(is_valid_twilio_request(settings))
+
+		# JSON bodies are only trusted through their hash
+		set_request(body, signature, query_string=None)
+		self.assertFalse(is_valid_twilio_request(settings))
+
+	def test_high_priority_bucket_reserve(self):
+		sender = frappe.generate_hash(length=10)
+		bulk, high = get_bucket("AC", sender, 5), get_bucket("AC", sender, 5, "High")
+
+		# A bulk drain takes everything but the reserve, which High still finds there
+		for _i in range(5):
+			bulk.acquire()
+		started = time.monotonic()
+		high.acquire()
+		self.assertLess(time.monotonic() - started, 0.1)
+
+	def test_normalize_phone_number(self):
+		cases = [
+			("+255 712 345 678", None, "+255712345678"),
+			("00255712345678", None, "+255712345678"),
+			("whatsapp:+255712345678", None, "+255712345678"),
+			("0712345678", "255", "+255712345678"),
+			("0712-345-678", "+255", "+255712345678"),
+			("255712345678", "255", "+255712345678"),
+			# Bare numbers of international length keep their own country code
+			("255712345678", None, "+255712345678"),
+			("14155552671", "255", "+14155552671"),
+			# Bare national numbers take the default country
+			("712345678", "255", "+255712345678"),
+			("4155552671", "1", "+14155552671"),
+			("712345678", None, "+712345678"),
+			("0712345678", None, None),
+			("+0712345678", None, None),
+			("1234", "255", None),
+			("not a number", "255", None),
+			("", "255", None),
+		]
+		for number, country_code, expected in cases:
+			with self.subTest(number=number, country_code=country_code):
+				self.assertEqual(normalize_phone_number(number, country_code), expected)
@@ -35,6 +35,25 @@ frappe.ui.form.on('Twilio Settings', {
                 }
             });
         }, __('Actions')).addClass('btn-primary btn-success'); // Green-Blue Button
+
+        // ✅ Add Button for Viewing Sampled Webhook Events
+        frm.add_custom_button(__('View Webhook Events'), function() {
+            frappe.call({
+                method: 'tenacious_integration.tenacious_integration.webhook_log.get_recent_webhook_events',
+                args: {
+                    limit: 50
+                },
+                callback: function(response) {
+                    // Payloads come from guest webhooks: escape them before they reach the DOM
+                    const events = frappe.utils.escape_html(JSON.stringify(response.message || [], null, 2));
+                    frappe.msgprint({
+                        title: __('Recent Webhook Events'),
+                        message: `<pre>${events}</pre>`,
+                        wide: true
+                    });
+                }
+            });
+        }, __('Actions'));
     }
 });
 
@@ -6,4 +6,17 @@ from frappe.model.document import Document
 
 
 class TwilioSettings(Document):
-	pass
+	@property
+	def circuit_state(self):
+		from tenacious_integration.tenacious_integration.circuit_breaker import describe_circuit
+
+		return describe_circuit("Twilio")
+
+	def on_update(self):
+		from tenacious_integration.tenacious_integration.settings import clear_settings_cache
+		from tenacious_integration.tenacious_integration.twilio_client import clear_twilio_clients
+		from tenacious_integration.tenacious_integration.whatsapp_webhook import clear_workflow_meta_cache
+
+		clear_settings_cache(self.doctype)
+		clear_twilio_clients()
+		clear_workflow_meta_cache()
@@ -1,9 +1,67 @@
 # Copyright (c) 2025, Joshua Joseph Michael and Contributors
 # See license.txt
 
-# import frappe
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from tenacious_integration.tenacious_integration.api import send_bulk_sms
+from tenacious_integration.tenacious_integration.doctype.twilio_sms_log.twilio_sms_log import bulk_insert_sms_logs
+from tenacious_integration.tenacious_integration.idempotency import claim_send, finish_send, release_send
+from tenacious_integration.tenacious_integration.message_status import apply_status_update
+
 
 class TestTwilioSMSLog(FrappeTestCase):
-	pass
+	def test_bulk_insert_sms_logs(self):
+		names = bulk_insert_sms_logs(
+			[
+				{"to_number": "+255700000001", "message_content": "Hello"},
+				{"to_number": "+255700000002", "message_content": "Hello"},
+			]
+		)
+
+		self.assertEqual(len(names), 2)
+		log = frappe.get_doc("Twilio SMS Log", names[0])
+		self.assertEqual(log.to_number, "+255700000001")
+		self.assertEqual(log.message_content, "Hello")
+		self.assertEqual(log.status, "Queued")
+
+	def test_bulk_insert_sms_logs_empty(self):
+		self.assertEqual(bulk_insert_sms_logs([]), [])
+
+	def test_bulk_insert_sms_logs_claim_token(self):
+		# Rows inserted already claimed are not picked up by another dispatcher
+		names = bulk_insert_sms_logs([{"to_number": "+255700000003", "message_content": "Hello", "claim_token": "abc"}])
+		self.assertEqual(frappe.db.get_value("Twilio SMS Log", names[0], "claim_token"), "abc")
+
+	def test_bulk_insert_sms_logs_priority(self):
+		names = bulk_insert_sms_logs(
+			[
+				{"to_number": "+255700000004", "message_content": "Hello"},
+				{"to_number": "+255700000005", "message_content": "Hello", "priority": "High"},
+			]
+		)
+		self.assertEqual([frappe.db.get_value("Twilio SMS Log", name, "priority") for name in names], ["Normal", "High"])
+
+	def test_unconfirmed_send_is_not_claimed_again(self):
+		name = bulk_insert_sms_logs([{"to_number": "+255700000006", "message_content": "Hello"}])[0]
+		self.addCleanup(release_send, "Twilio SMS Log", name)
+
+		self.assertEqual(claim_send("Twilio SMS Log", name), (True, None))
+		finish_send("Twilio SMS Log", name, {"error": "Read timed out", "unconfirmed": True})
+		self.assertEqual(claim_send("Twilio SMS Log", name), (False, None))
+
+		# Only an explicit resend releases it
+		release_send("Twilio SMS Log", name)
+		self.assertEqual(claim_send("Twilio SMS Log", name), (True, None))
+
+	def test_read_callback_marks_delivered(self):
+		# SMS has no Read status, so a read callback counts as delivery
+		name = bulk_insert_sms_logs([{"to_number": "+255700000007", "message_content": "Hello"}])[0]
+		sid = f"SM{frappe.generate_hash(length=32)}"
+		frappe.db.set_value("Twilio SMS Log", name, {"message_sid": sid, "status": "Sent"})
+
+		apply_status_update("Twilio SMS Log", sid, "read")
+		self.assertEqual(frappe.db.get_value("Twilio SMS Log", name, "status"), "Delivered")
+
+	def test_send_bulk_sms_invalid_priority(self):
+		self.assertRaises(frappe.ValidationError, send_bulk_sms, ["+255700000001"], "Hello", priority="Urgent")
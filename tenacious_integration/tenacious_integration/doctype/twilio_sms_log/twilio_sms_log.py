@@ -1,9 +1,22 @@
 # Copyright (c) 2025, Joshua Joseph Michael and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
+from tenacious_integration.tenacious_integration.message_log import bulk_insert_logs
+
+BULK_LOG_FIELDS = ("to_number", "message_content", "status", "claim_token", "claimed_at", "priority")
+
 
 class TwilioSMSLog(Document):
-	pass
+	def after_insert(self):
+		if self.priority == "High" and self.status == "Queued" and not self.message_sid:
+			from tenacious_integration.tenacious_integration.dispatcher import enqueue_high_priority_dispatch
+
+			enqueue_high_priority_dispatch()
+
+
+def bulk_insert_sms_logs(logs):
+	"""Insert many Twilio SMS Log rows with one multi-row INSERT. See bulk_insert_logs."""
+	return bulk_insert_logs("Twilio SMS Log", logs, BULK_LOG_FIELDS, {"status": "Queued", "priority": "Normal"})
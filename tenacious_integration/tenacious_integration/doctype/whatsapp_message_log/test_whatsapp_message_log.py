@@ -1,9 +1,85 @@
 # Copyright (c) 2025, Joshua Joseph Michael and Contributors
 # See license.txt
 
-# import frappe
+from unittest.mock import patch
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from tenacious_integration.tenacious_integration.doctype.whatsapp_message_log.whatsapp_message_log import (
+	bulk_insert_message_logs,
+)
+from tenacious_integration.tenacious_integration.whatsapp_webhook import (
+	DIGEST_DUE_KEY,
+	DIGEST_QUEUE_KEY,
+	add_to_digests,
+	flush_notification_digests,
+	send_workflow_notifications,
+)
+
+WEBHOOK_MODULE = "tenacious_integration.tenacious_integration.whatsapp_webhook"
+
 
 class TestWhatsAppMessageLog(FrappeTestCase):
-	pass
+	def test_bulk_insert_message_logs(self):
+		names = bulk_insert_message_logs(
+			[{"to_number": "255700000001", "message_content": "Hello"}, {"to_number": "255700000002", "message_content": "Hello"}]
+		)
+
+		self.assertEqual(len(names), 2)
+		log = frappe.get_doc("WhatsApp Message Log", names[1])
+		self.assertEqual(log.to_number, "255700000002")
+		self.assertEqual(log.status, "Queued")
+
+		log.message_id = "SM123"
+		log.update_status("Sent")
+		self.assertEqual(frappe.db.get_value("WhatsApp Message Log", names[1], "status"), "Sent")
+
+	@patch(f"{WEBHOOK_MODULE}.enqueue_dispatch")
+	@patch(f"{WEBHOOK_MODULE}.get_workflow_meta", return_value={"digest_window": 0})
+	@patch(f"{WEBHOOK_MODULE}.get_recipients_for_workflow")
+	def test_send_workflow_notifications(self, get_recipients, get_workflow_meta, enqueue_dispatch):
+		recipients = ["+255700000011", "+255700000012", "+255700000013"]
+		get_recipients.return_value = recipients
+
+		send_workflow_notifications("ToDo", "TODO-WF-1", "Approved", "ToDo TODO-WF-1 is Approved")
+
+		logs = frappe.get_all(
+			"WhatsApp Message Log",
+			filters={"reference_doctype": "ToDo", "reference_name": "TODO-WF-1"},
+			fields=["to_number", "message_content", "status"],
+		)
+		self.assertEqual(sorted(log.to_number for log in logs), recipients)
+		self.assertTrue(all(log.message_content == "ToDo TODO-WF-1 is Approved" for log in logs))
+		self.assertTrue(all(log.status == "Queued" for log in logs))
+		enqueue_dispatch.assert_called_once()
+
+	@patch(f"{WEBHOOK_MODULE}.enqueue_dispatch")
+	def test_flush_notification_digests(self, enqueue_dispatch):
+		recipient = "+255700000009"
+		member = f"ToDo|{recipient}"
+		cache = frappe.cache()
+		cache.delete_value(f"{DIGEST_QUEUE_KEY}:{member}")
+
+		# A window of 0 makes the digest due at once
+		add_to_digests("ToDo", "TODO-1", [recipient], "First update", 0)
+		add_to_digests("ToDo", "TODO-2", [recipient], "Second update", 0)
+		flush_notification_digests()
+
+		logs = frappe.get_all(
+			"WhatsApp Message Log",
+			filters={"to_number": recipient, "reference_doctype": "ToDo"},
+			fields=["message_content", "reference_name", "priority"],
+		)
+		self.assertEqual(len(logs), 1)
+		self.assertIn("First update", logs[0].message_content)
+		self.assertIn("Second update", logs[0].message_content)
+		self.assertIsNone(logs[0].reference_name)
+		self.assertEqual(logs[0].priority, "Low")
+		enqueue_dispatch.assert_called_once()
+
+		# The flushed digest is gone, so the next run sends nothing again
+		self.assertEqual(cache.llen(f"{DIGEST_QUEUE_KEY}:{member}"), 0)
+		pipe = cache.pipeline()
+		pipe.zscore(cache.make_key(DIGEST_DUE_KEY), member)
+		self.assertIsNone(pipe.execute()[0])
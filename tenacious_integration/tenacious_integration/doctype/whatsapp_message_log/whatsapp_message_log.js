@@ -5,7 +5,7 @@ frappe.ui.form.on('WhatsApp Message Log', {
     refresh: function(frm) {
         // Add resend button for failed messages
         // Add "Send Message" button for new messages
-        if (!frm.doc.message_id && frm.doc.status !== "Sent") {
+        if (!frm.doc.message_id && !["Sent", "Unconfirmed"].includes(frm.doc.status)) {
             frm.add_custom_button(__('Send Message'), function() {
                 frappe.call({
                     method: 'tenacious_integration.tenacious_integration.api.send_whatsapp_message',
@@ -24,7 +24,7 @@ frappe.ui.form.on('WhatsApp Message Log', {
             }).addClass('btn-primary');
         }
 
-        if (frm.doc.status === "Failed") {
+        if (["Failed", "Unconfirmed"].includes(frm.doc.status)) {
             frm.add_custom_button(__('Resend Message'), function() {
                 frappe.confirm(
                     __('Are you sure you want to resend this message?'),
@@ -58,7 +58,8 @@ frappe.ui.form.on('WhatsApp Message Log', {
                 "Sent": "orange", 
                 "Delivered": "green",
                 "Read": "darkgreen",
-                "Failed": "red"
+                "Failed": "red",
+                "Unconfirmed": "yellow"
             };
             
             frm.set_indicator(frm.doc.status, status_color[frm.doc.status]);
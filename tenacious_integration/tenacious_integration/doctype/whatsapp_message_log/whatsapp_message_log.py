@@ -6,11 +6,30 @@ import frappe
 from frappe import _
 from frappe.model.document import Document
 import json
+from tenacious_integration.tenacious_integration.message_log import bulk_insert_logs
+
+BULK_LOG_FIELDS = (
+    "to_number",
+    "message_type",
+    "message_content",
+    "status",
+    "queued_at",
+    "reference_doctype",
+    "reference_name",
+    "claim_token",
+    "claimed_at",
+    "priority",
+)
 
 class WhatsAppMessageLog(Document):
     def validate(self):
         if not self.message_id and self.status == "Sent":
             frappe.throw(_("Message ID is required for sent messages"))
+
+    def after_insert(self):
+        if self.priority == "High" and self.status == "Queued" and not self.message_id:
+            from tenacious_integration.tenacious_integration.dispatcher import enqueue_high_priority_dispatch
+            enqueue_high_priority_dispatch()
     
     def update_status(self, status, error_message=None):
         """Update message status and corresponding timestamp"""
@@ -35,15 +54,23 @@ class WhatsAppMessageLog(Document):
 
     @frappe.whitelist()
     def resend(self):
-        """Resend a failed message"""
-        if self.status != "Failed":
-            frappe.throw(_("Only failed messages can be resent"))
+        """Resend a failed message, or an unconfirmed one that was checked in Twilio and never sent"""
+        if self.status not in ("Failed", "Unconfirmed"):
+            frappe.throw(_("Only failed or unconfirmed messages can be resent"))
+
+        if self.status == "Unconfirmed":
+            from tenacious_integration.tenacious_integration.idempotency import release_send
+            release_send(self.doctype, self.name)
+            self.db_set("status", "Queued")
 
         try:
             from tenacious_integration.tenacious_integration.api import send_whatsapp_message
             result = send_whatsapp_message(doc_name=self.name)
 
-            if result.get("success"):
+            if result.get("duplicate"):
+                # Twilio already accepted this message; sending it again is never done
+                return result
+            elif result.get("success"):
                 self.update_status("Queued")  # Set status to "Queued" after resending
                 return result
             else:
@@ -54,20 +81,13 @@ class WhatsAppMessageLog(Document):
             return {"success": False, "error": str(e)}
 
     @frappe.whitelist()
-    def process_queued_messages():
+    def process_queued_messages(self):
         """Send all messages that are in the 'Queued' status"""
-        queued_messages = frappe.get_all("WhatsApp Message Log", filters={"status": "Queued"})
-        for msg in queued_messages:
-            doc = frappe.get_doc("WhatsAppMessageLog", msg.name)
-            try:
-                from tenacious_integration.tenacious_integration.api import send_whatsapp_message
-                result = send_whatsapp_message(doc_name=doc.name)
-
-                if result.get("success"):
-                    doc.update_status("Sent")
-                else:
-                    doc.update_status("Failed", result.get("error", "Unknown error"))
-
-            except Exception as e:
-                doc.update_status("Failed", str(e))
-                frappe.log_error(_("Error sending queued WhatsApp message"), frappe.get_traceback())
+        from tenacious_integration.tenacious_integration.dispatcher import dispatch_queued_messages
+        return dispatch_queued_messages()
+
+
+def bulk_insert_message_logs(logs):
+    """Insert many WhatsApp Message Log rows with one multi-row INSERT. See bulk_insert_logs."""
+    defaults = {"message_type": "Text", "status": "Queued", "queued_at": frappe.utils.now(), "priority": "Normal"}
+    return bulk_insert_logs("WhatsApp Message Log", logs, BULK_LOG_FIELDS, defaults)
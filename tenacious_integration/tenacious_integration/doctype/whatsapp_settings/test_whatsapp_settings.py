@@ -1,9 +1,31 @@
 # Copyright (c) 2025, Joshua Joseph Michael and Contributors
 # See license.txt
 
-# import frappe
+from unittest.mock import patch
+
 from frappe.tests.utils import FrappeTestCase
 
+from tenacious_integration.tenacious_integration.whatsapp_webhook import (
+	get_workflow_meta,
+	retire_workflow_meta_version,
+)
+
+WEBHOOK_MODULE = "tenacious_integration.tenacious_integration.whatsapp_webhook"
+
 
 class TestWhatsAppSettings(FrappeTestCase):
-	pass
+	def test_workflow_meta_follows_shared_version(self):
+		retire_workflow_meta_version()
+		with patch(f"{WEBHOOK_MODULE}.build_workflow_meta", return_value={"digest_window": 30}):
+			self.assertEqual(get_workflow_meta("ToDo")["digest_window"], 30)
+
+		# The copy in this worker is kept while the version is unchanged
+		with patch(f"{WEBHOOK_MODULE}.build_workflow_meta", return_value={"digest_window": 60}) as build:
+			self.assertEqual(get_workflow_meta("ToDo")["digest_window"], 30)
+			build.assert_not_called()
+
+			# What a settings update in another worker does in Redis
+			retire_workflow_meta_version()
+			self.assertEqual(get_workflow_meta("ToDo")["digest_window"], 60)
+
+		retire_workflow_meta_version()
@@ -7,6 +7,11 @@ from frappe import _
 from frappe.model.document import Document
 
 class WhatsAppSettings(Document):
-    pass
+    def on_update(self):
+        from tenacious_integration.tenacious_integration.settings import clear_settings_cache
+        from tenacious_integration.tenacious_integration.whatsapp_webhook import clear_workflow_meta_cache
+
+        clear_settings_cache(self.doctype)
+        clear_workflow_meta_cache()
     
 
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import frappe
+from frappe.utils import now_datetime
+
+from tenacious_integration.tenacious_integration import backup_stream
+
+# Incremental file backups store each distinct file content once on OneDrive,
+# named by its SHA-256, and a per-run manifest mapping every site file to the
+# object holding its content. A local manifest remembers the size, mtime and
+# hash of every file seen, so a run only hashes files that changed, and which
+# objects OneDrive already has, so it only uploads new content.
+
+HASH_BUFFER_SIZE = 1024 * 1024
+FILE_ROOTS = (("public", "files"), ("private", "files"))
+LOCAL_MANIFEST = "onedrive_file_manifest.json"  # under the site's private folder, outside the backups it keeps
+MANIFEST_VERSION = 1
+
+
+def get_local_manifest_path():
+    return frappe.get_site_path("private", LOCAL_MANIFEST)
+
+
+def load_local_manifest(folder_id):
+    """
+    The local manifest: {"files": {path: [size, mtime, sha256]}, "objects": set of
+    hashes uploaded}. Objects are forgotten when the backup folder changed, since
+    the new folder does not have them.
+    """
+    try:
+        with open(get_local_manifest_path()) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        data = {}
+    except ValueError:
+        frappe.logger().warning("Local file manifest is unreadable. Hashing every file again.")
+        data = {}
+
+    return {
+        "folder_id": folder_id,
+        "files": data.get("files", {}),
+        "objects": set(data.get("objects", [])) if data.get("folder_id") == folder_id else set(),
+    }
+
+
+def save_local_manifest(manifest):
+    """Write the local manifest atomically, so a killed job never leaves half of it."""
+    path = get_local_manifest_path()
+    data = dict(manifest, objects=sorted(manifest["objects"]))
+
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(f"{path}.tmp", path)
+
+
+def scan_files(known, workers):
+    """
+    {path relative to the site: [size, mtime, sha256]} for every public and
+    private file. Files whose size and mtime match `known` keep their hash;
+    the others are hashed, `workers` at a time.
+    """
+    site_path = frappe.get_site_path()
+    files, changed = {}, []
+
+    for root in FILE_ROOTS:
+        for dirpath, _dirs, names in os.walk(os.path.join(site_path, *root)):
+            for name in names:
+                path = os.path.relpath(os.path.join(dirpath, name), site_path)
+                try:
+                    stat = os.stat(os.path.join(site_path, path))
+                except FileNotFoundError:
+                    continue
+
+                entry = known.get(path)
+                if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+                    files[path] = entry
+                else:
+                    files[path] = [stat.st_size, stat.st_mtime, None]
+                    changed.append(path)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        digests = pool.map(hash_file, [os.path.join(site_path, path) for path in changed])
+        for path, digest in zip(changed, digests):
+            files[path][2] = digest
+
+    # Drop files deleted while the scan ran
+    return {path: entry for path, entry in files.items() if entry[2]}
+
+
+def is_unchanged(path, entry):
+    """Whether the file at `path`, relative to the site, still has the size and mtime of its manifest entry."""
+    try:
+        stat = os.stat(frappe.get_site_path(path))
+    except FileNotFoundError:
+        return False
+    return entry[0] == stat.st_size and entry[1] == stat.st_mtime
+
+
+def hash_file(path):
+    """SHA-256 of a file, or None if it no longer exists. Runs in worker threads."""
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            while chunk := f.read(HASH_BUFFER_SIZE):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def write_run_manifest(files):
+    """Write this run's manifest next to the other backup artifacts and return its path."""
+    site = frappe.local.site
+    file_name = f"{now_datetime().strftime('%Y%m%d_%H%M%S')}-{site.replace('.', '_')}-files-manifest.json"
+    manifest_path = frappe.get_site_path("private", "backups", file_name)
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "site": site,
+        "created": str(now_datetime()),
+        "files": {
+            path: {"size": size, "mtime": mtime, "sha256": digest} for path, (size, mtime, digest) in sorted(files.items())
+        },
+    }
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+
+    return manifest_path
+
+
+def restore_files(manifest_path, objects_dir, site_path, passphrase=None):
+    """
+    Rebuild the files of a run under `site_path` from its manifest and the
+    objects folder downloaded into `objects_dir`, checking every file against
+    its hash. Decode a compressed manifest with backup_stream.decode_backup first, e.g.
+    bench --site x execute tenacious_integration.tenacious_integration.file_manifest.restore_files
+    --kwargs "{'manifest_path': '...', 'objects_dir': '...', 'site_path': '...', 'passphrase': '...'}"
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    for path, entry in manifest["files"].items():
+        target = os.path.normpath(os.path.join(site_path, path))
+        if not target.startswith(os.path.join(os.path.normpath(site_path), "")):
+            raise ValueError(f"{path} is outside the site")
+
+        source = find_object(objects_dir, entry["sha256"])
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if source.endswith((".zst", ".zst.enc")):
+            backup_stream.decode_backup(source, target, passphrase)
+        else:
+            shutil.copyfile(source, target)
+
+        if hash_file(target) != entry["sha256"]:
+            raise ValueError(f"{path} does not match its hash")
+
+
+def find_object(objects_dir, digest):
+    """The downloaded object of a hash, whichever encoding it was uploaded with."""
+    for suffix in ("", ".zst", ".zst.enc"):
+        path = os.path.join(objects_dir, digest + suffix)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"Object {digest} is missing from {objects_dir}")
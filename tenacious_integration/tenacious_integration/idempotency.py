@@ -0,0 +1,84 @@
+import frappe
+
+SEND_KEY_PREFIX = "tenacious_integration:send"
+SEND_CLAIM_TTL = 15 * 60  # seconds a claim is held while the Twilio call is in flight
+SENT_TTL = 2 * 24 * 60 * 60  # seconds the SID of an accepted message, or an unconfirmed send, is remembered
+PENDING = "pending"
+UNCONFIRMED = "unconfirmed"  # Twilio never answered, so it may have accepted the message
+
+
+def get_idempotency_key(doctype, name):
+    """The idempotency key of one log row: every send of that row shares it."""
+    return f"{SEND_KEY_PREFIX}:{doctype}:{name}"
+
+
+def claim_sends(rows):
+    """
+    Atomically claim the right to send each (doctype, name) in `rows` with a
+    SET NX per idempotency key. Returns one (claimed, sid) pair per row: a row
+    that is not claimed is either being sent elsewhere or held as unconfirmed
+    (sid None), or was already accepted by Twilio (sid set), and must not be
+    sent again.
+    """
+    if not rows:
+        return []
+
+    cache = frappe.cache()
+    keys = [cache.make_key(get_idempotency_key(doctype, name)) for doctype, name in rows]
+
+    pipe = cache.pipeline(transaction=False)
+    for key in keys:
+        pipe.set(key, PENDING, nx=True, ex=SEND_CLAIM_TTL)
+    claimed = pipe.execute()
+
+    held = [key for key, ok in zip(keys, claimed) if not ok]
+    values = dict(zip(held, cache.mget(held))) if held else {}
+
+    results = []
+    for key, ok in zip(keys, claimed):
+        value = values.get(key)
+        if isinstance(value, bytes):
+            value = value.decode()
+        results.append((bool(ok), None if ok or value in (None, PENDING, UNCONFIRMED) else value))
+    return results
+
+
+def claim_send(doctype, name):
+    """Claim the send of a single log row. See claim_sends."""
+    return claim_sends([(doctype, name)])[0]
+
+
+def finish_sends(outcomes):
+    """
+    Settle claims once the Twilio calls return. `outcomes` holds
+    (doctype, name, result) with result as returned by the sender: an accepted
+    message keeps its key, now holding the SID, so later retries find it; an
+    unconfirmed one (a timeout after the request went out) keeps it for
+    SENT_TTL, until someone checks Twilio and resends it explicitly. Any other
+    message (rejected by Twilio, failed before reaching it, or deferred) is
+    released so it can be sent later.
+    """
+    if not outcomes:
+        return
+
+    cache = frappe.cache()
+    pipe = cache.pipeline(transaction=False)
+    for doctype, name, result in outcomes:
+        key = cache.make_key(get_idempotency_key(doctype, name))
+        if result.get("sid"):
+            pipe.set(key, result["sid"], ex=SENT_TTL)
+        elif result.get("unconfirmed"):
+            pipe.set(key, UNCONFIRMED, ex=SENT_TTL)
+        else:
+            pipe.delete(key)
+    pipe.execute()
+
+
+def finish_send(doctype, name, result):
+    """Settle the claim of a single log row. See finish_sends."""
+    finish_sends([(doctype, name, result)])
+
+
+def release_send(doctype, name):
+    """Drop the idempotency key of a log row, once an unconfirmed send was checked and is to be sent again."""
+    frappe.cache().delete_value(get_idempotency_key(doctype, name))
@@ -0,0 +1,25 @@
+import frappe
+
+LOG_DEFAULT_FIELDS = ["name", "creation", "modified", "owner", "modified_by", "docstatus"]
+
+
+def bulk_insert_logs(doctype, logs, fields, defaults):
+    """
+    Insert many message log rows with a single multi-row INSERT, skipping
+    per-row validation and hooks. `logs` is a list of dicts keyed by `fields`;
+    missing values come from `defaults`. Returns the generated names in order.
+    """
+    if not logs:
+        return []
+
+    now = frappe.utils.now()
+    user = frappe.session.user
+
+    names = [frappe.generate_hash(length=10) for _log in logs]
+    values = [
+        (name, now, now, user, user, 0, *(log.get(f) or defaults.get(f) for f in fields))
+        for name, log in zip(names, logs)
+    ]
+
+    frappe.db.bulk_insert(doctype, fields=[*LOG_DEFAULT_FIELDS, *fields], values=values)
+    return names
@@ -0,0 +1,201 @@
+import json
+import frappe
+from frappe.query_builder.functions import Coalesce
+
+STATUS_BUFFER_KEY = "tenacious_integration:status_callbacks"
+STATUS_BATCH_SIZE = 1000
+STATUS_BUFFER_MAX = 100_000  # records; past this, callbacks are applied directly instead of buffered
+
+# Twilio callback status -> log status
+TWILIO_STATUS_MAP = {
+    "accepted": "Queued",
+    "scheduled": "Queued",
+    "queued": "Queued",
+    "sending": "Queued",
+    "sent": "Sent",
+    "delivered": "Delivered",
+    "read": "Read",
+    "undelivered": "Failed",
+    "failed": "Failed",
+    "canceled": "Failed",
+}
+
+# Statuses only move forward; Failed is terminal
+STATUS_RANK = {"Queued": 0, "Sent": 1, "Delivered": 2, "Read": 3}
+FAILABLE_STATUSES = ("Queued", "Sent")
+
+STATUS_LOGS = {
+    "WhatsApp Message Log": {
+        "sid_field": "message_id",
+        "timestamps": {"Sent": "sent_at", "Delivered": "delivered_at", "Read": "read_at"},
+        "error_fields": ("error_message",),
+        "statuses": {},
+    },
+    "Twilio SMS Log": {
+        "sid_field": "message_sid",
+        "timestamps": {},
+        "error_fields": ("error_code", "error_message"),
+        # SMS has no read receipts; a read callback still means it was delivered
+        "statuses": {"Read": "Delivered"},
+    },
+}
+
+
+# Single-letter doctype codes keep buffered records small
+BUFFER_DOCTYPE_CODES = {"WhatsApp Message Log": "W", "Twilio SMS Log": "S"}
+BUFFER_DOCTYPES = {code: doctype for doctype, code in BUFFER_DOCTYPE_CODES.items()}
+
+
+def get_log_status(doctype, twilio_status):
+    """Map a Twilio MessageStatus to a status of the log doctype, or None for statuses we do not track."""
+    status = TWILIO_STATUS_MAP.get((twilio_status or "").lower())
+    return STATUS_LOGS[doctype]["statuses"].get(status, status)
+
+
+def get_statuses_before(status):
+    """Statuses a log may be in for `status` to be applied on top of it."""
+    if status == "Failed":
+        return FAILABLE_STATUSES
+    return [s for s, rank in STATUS_RANK.items() if rank < STATUS_RANK[status]]
+
+
+def apply_status_update(doctype, sid, twilio_status, error_code=None, error_message=None):
+    """
+    Apply a Twilio status callback to the log row with this SID in one
+    conditional UPDATE on the indexed SID column. Late or out-of-order
+    callbacks match no row and cost nothing more.
+    """
+    status = get_log_status(doctype, twilio_status)
+    if not sid or not status:
+        return
+
+    apply_log_status(doctype, [sid], status, error_code, error_message)
+
+
+def apply_log_status(doctype, sids, status, error_code=None, error_message=None):
+    """Move every log row with one of `sids` to `status`, where that is a forward move."""
+    config = STATUS_LOGS[doctype]
+    table = frappe.qb.DocType(doctype)
+    now = frappe.utils.now()
+
+    query = (
+        frappe.qb.update(table)
+        .set(table.status, status)
+        .set(table.modified, now)
+        .where(table[config["sid_field"]].isin(sids))
+        .where(table.status.isin(get_statuses_before(status)))
+    )
+
+    timestamp_field = config["timestamps"].get(status)
+    if timestamp_field:
+        query = query.set(table[timestamp_field], Coalesce(table[timestamp_field], now))
+
+    if status == "Failed":
+        errors = {"error_code": error_code, "error_message": error_message}
+        for field in config["error_fields"]:
+            if errors[field]:
+                query = query.set(table[field], errors[field])
+
+    query.run()
+
+
+def buffer_status_callback(doctype, sid, twilio_status, error_code=None, error_message=None):
+    """
+    Push a compact status record onto the Redis buffer instead of touching the
+    database. While the buffer is full (the consumer is behind or down) the
+    callback is applied directly, so Redis memory stays bounded and nothing is lost.
+    """
+    status = get_log_status(doctype, twilio_status)
+    if not sid or not status:
+        return
+
+    if frappe.cache().llen(STATUS_BUFFER_KEY) >= STATUS_BUFFER_MAX:
+        apply_log_status(doctype, [sid], status, error_code, error_message)
+        return
+
+    record = [BUFFER_DOCTYPE_CODES[doctype], sid, status, error_code, error_message]
+    frappe.cache().rpush(STATUS_BUFFER_KEY, json.dumps(record, separators=(",", ":")))
+
+
+def pop_status_records(limit):
+    """Atomically take up to `limit` records from the head of the buffer."""
+    cache = frappe.cache()
+    key = cache.make_key(STATUS_BUFFER_KEY)
+
+    pipe = cache.pipeline()
+    pipe.lrange(key, 0, limit - 1)
+    pipe.ltrim(key, limit, -1)
+    records, _ = pipe.execute()
+
+    return [json.loads(record) for record in records]
+
+
+def coalesce_status_records(records):
+    """
+    Reduce buffered records to one final status per (doctype, SID), applying
+    them in arrival order with the same forward-only rules as the database.
+    """
+    final = {}
+
+    for code, sid, status, error_code, error_message in records:
+        key = (BUFFER_DOCTYPES[code], sid)
+        current = final.get(key)
+
+        if (
+            not current
+            or (status == "Failed" and current[0] in FAILABLE_STATUSES)
+            or (current[0] != "Failed" and status != "Failed" and STATUS_RANK[status] > STATUS_RANK[current[0]])
+        ):
+            final[key] = (status, error_code, error_message)
+
+    return final
+
+
+def flush_status_buffer(batch_size=STATUS_BATCH_SIZE):
+    """
+    Background job: apply buffered status callbacks batch by batch. Callbacks
+    for the same SID are coalesced, and rows moving to the same status are
+    updated together.
+    """
+    while True:
+        records = pop_status_records(batch_size)
+        if not records:
+            break
+
+        try:
+            apply_status_records(records)
+            frappe.db.commit()
+        except Exception:
+            # Put the batch back so the next run retries it
+            frappe.db.rollback()
+            pipe = frappe.cache().pipeline()
+            pipe.rpush(frappe.cache().make_key(STATUS_BUFFER_KEY), *(json.dumps(r, separators=(",", ":")) for r in records))
+            pipe.execute()
+            raise
+
+
+def apply_status_records(records):
+    """Apply one batch of buffered records with one UPDATE per doctype and target status."""
+    grouped = {}
+    for (doctype, sid), (status, error_code, error_message) in coalesce_status_records(records).items():
+        if status == "Failed" and (error_code or error_message):
+            # Error details differ per message, so these rows are updated one by one
+            apply_log_status(doctype, [sid], status, error_code, error_message)
+        else:
+            grouped.setdefault((doctype, status), []).append(sid)
+
+    for (doctype, status), sids in grouped.items():
+        apply_log_status(doctype, sids, status)
+
+
+def enqueue_flush_status_buffer():
+    """Scheduler entry point: start the buffer consumer unless one is already running."""
+    if not frappe.cache().llen(STATUS_BUFFER_KEY):
+        return
+
+    frappe.enqueue(
+        "tenacious_integration.tenacious_integration.message_status.flush_status_buffer",
+        queue="short",
+        job_id="tenacious_integration:flush_status_buffer",
+        deduplicate=True,
+    )
@@ -0,0 +1,58 @@
+import re
+from functools import lru_cache
+
+E164_PATTERN = re.compile(r"^\+[1-9]\d{7,14}$")
+SEPARATORS = re.compile(r"[\s().\-/]")
+CHANNEL_PREFIXES = ("whatsapp:", "sms:")
+NATIONAL_NUMBER_MAX_DIGITS = 10  # longer bare numbers already carry a country code
+
+
+def normalize_phone_number(number, default_country_code=None):
+    """
+    Convert a recipient number to E.164 (e.g. "+255712345678"), or return None
+    if it cannot be a valid number. Numbers are read as:
+
+    - "+255 712 345 678" or "00255712345678": international;
+    - "0712345678": national, the trunk 0 replaced by `default_country_code`;
+    - "255712345678" or "14155552671": bare digits longer than
+      NATIONAL_NUMBER_MAX_DIGITS are international without the plus, as
+      stored by older logs;
+    - "712345678": shorter bare digits are national, prefixed with
+      `default_country_code`.
+
+    Without a default country code every bare number is read as international,
+    as older versions did.
+
+    Results are cached per process, so repeat recipients cost a dict lookup.
+    """
+    return _normalize(str(number or ""), str(default_country_code or ""))
+
+
+@lru_cache(maxsize=8192)
+def _normalize(number, default_country_code):
+    number = number.strip().lower()
+    for prefix in CHANNEL_PREFIXES:
+        if number.startswith(prefix):
+            number = number[len(prefix):]
+
+    number = SEPARATORS.sub("", number)
+    country_code = default_country_code.strip().lstrip("+")
+
+    if number.startswith("+"):
+        number = number[1:]
+    elif number.startswith("00"):
+        number = number[2:]
+    elif number.startswith("0"):
+        if not country_code:
+            return None
+        number = country_code + number[1:]
+    elif country_code and len(number) <= NATIONAL_NUMBER_MAX_DIGITS:
+        number = country_code + number
+
+    number = "+" + number
+    return number if E164_PATTERN.match(number) else None
+
+
+def normalize_recipient(settings, number):
+    """Normalize a number with the Default Country Code from Twilio Settings."""
+    return normalize_phone_number(number, settings.default_country_code)
@@ -0,0 +1,57 @@
+import bisect
+import hashlib
+import frappe
+
+VIRTUAL_NODES = 100  # points per sender on the ring; more gives a more even spread
+
+_rings = {}  # (site, channel, settings version) -> HashRing; a worker may serve several sites
+
+
+class HashRing:
+    """Consistent hash ring mapping a recipient to one sender, so adding a sender only moves ~1/n recipients."""
+
+    def __init__(self, senders):
+        self.points = []
+        self.senders = {}
+
+        for sender in senders:
+            for i in range(VIRTUAL_NODES):
+                point = get_hash(f"{sender.account_sid or ''}:{sender.phone_number}:{i}")
+                self.points.append(point)
+                self.senders[point] = sender
+
+        self.points.sort()
+
+    def get(self, recipient):
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, get_hash(recipient)) % len(self.points)
+        return self.senders[self.points[index]]
+
+
+def get_hash(value):
+    return int(hashlib.md5(value.encode()).hexdigest()[:16], 16)
+
+
+def get_pool_sender(settings, channel, recipient):
+    """
+    Return the Twilio Sender row for a recipient on a channel ("WhatsApp" or
+    "SMS"), or None when the pool has no enabled sender for it. Rings are built
+    once per process for each site and version of Twilio Settings.
+    """
+    key = (frappe.local.site, channel, str(settings.modified))
+    ring = _rings.get(key)
+
+    if ring is None:
+        senders = [
+            frappe._dict(row)
+            for row in settings.get("senders") or []
+            if row.get("enabled") and row.get("channel") == channel and row.get("phone_number")
+        ]
+        ring = HashRing(senders)
+        # Drop rings built for older versions of this site's settings
+        for old_key in [k for k in _rings if k[:2] == key[:2]]:
+            del _rings[old_key]
+        _rings[key] = ring
+
+    return ring.get(recipient)
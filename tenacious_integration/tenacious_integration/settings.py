@@ -0,0 +1,59 @@
+import time
+import frappe
+
+SETTINGS_LOCAL_TTL = 60  # seconds a worker trusts its snapshot before re-checking the version
+
+_snapshots = {}  # (site, doctype) -> snapshot; a worker may serve several sites
+
+
+def get_settings(doctype):
+    """
+    Return a read-only snapshot of an integration Single (Twilio Settings,
+    Microsoft Settings, One Drive, Azampay Settings, ...) with its Password
+    fields already decrypted.
+
+    Snapshots live per worker process and site. After SETTINGS_LOCAL_TTL the shared
+    version in Redis is checked, and the Single is re-read only if it changed.
+    """
+    key = (frappe.local.site, doctype)
+    snapshot = _snapshots.get(key)
+    now = time.monotonic()
+
+    if snapshot and snapshot["expires"] > now:
+        return snapshot["values"]
+
+    version = frappe.cache().get_value(get_version_key(doctype))
+
+    if not snapshot or not version or snapshot["version"] != version:
+        if not version:
+            version = frappe.generate_hash(length=10)
+            frappe.cache().set_value(get_version_key(doctype), version)
+        snapshot = {"version": version, "values": load_settings(doctype)}
+        _snapshots[key] = snapshot
+
+    snapshot["expires"] = now + SETTINGS_LOCAL_TTL
+    return snapshot["values"]
+
+
+def load_settings(doctype):
+    """Read a Single from the database and decrypt its Password fields."""
+    doc = frappe.get_single(doctype)
+    values = frappe._dict(doc.as_dict(no_default_fields=True))
+    values.modified = doc.modified
+
+    for df in doc.meta.get("fields", {"fieldtype": "Password"}):
+        values[df.fieldname] = doc.get_password(df.fieldname, raise_exception=False)
+
+    return values
+
+
+def clear_settings_cache(doctype):
+    """Invalidate snapshots of a Single in every worker. Call after writing to it."""
+    _snapshots.pop((frappe.local.site, doctype), None)
+    frappe.cache().delete_value(get_version_key(doctype))
+    # Drop it again once committed, in case another worker reloaded the old row meanwhile
+    frappe.db.after_commit.add(lambda: frappe.cache().delete_value(get_version_key(doctype)))
+
+
+def get_version_key(doctype):
+    return f"tenacious_integration:settings_version:{frappe.scrub(doctype)}"
@@ -0,0 +1,160 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import frappe
+import requests
+from requests.adapters import HTTPAdapter
+
+from tenacious_integration.tenacious_integration.circuit_breaker import (
+    PROVIDER_TIMEOUTS,
+    acquire,
+    record_failure,
+    record_success,
+)
+
+DEFAULT_POOL_SIZE = 10  # keep-alive connections per host
+DEFAULT_RETRIES = 2
+BACKOFF_BASE = 0.5  # seconds, doubled on every retry
+RETRY_AFTER_MAX = 60  # longer Retry-After values are returned to the caller instead of waited out
+
+# Statuses worth another attempt. 429 and 503 normally mean the request was not
+# processed, so they are retried for any method unless the caller turns status
+# retries off (payments); the others only for idempotent methods.
+RETRY_ANY_METHOD = (429, 503)
+RETRY_IDEMPOTENT = (500, 502, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+_sessions = {}  # (site, scheme, host) -> Session; a worker may serve several sites
+_sessions_lock = threading.Lock()
+
+
+def get_session(url):
+    """
+    Return this process's pooled session for the site and the URL's host, so
+    repeated Graph and Azampay calls reuse keep-alive TCP and TLS connections.
+    Set `integration_http_pool_size` in site config to change the pool size.
+    """
+    parts = urlsplit(url)
+    key = (frappe.local.site, parts.scheme, parts.netloc)
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if not session:
+            pool_size = frappe.conf.get("integration_http_pool_size") or DEFAULT_POOL_SIZE
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session = _sessions[key] = requests.Session()
+            session.mount(f"{parts.scheme}://{parts.netloc}", adapter)
+
+    return session
+
+
+def get_timeout(provider):
+    """(connect, read) timeout for a provider; `integration_http_timeout` in site config overrides it."""
+    timeout = frappe.conf.get("integration_http_timeout")
+    return tuple(timeout) if isinstance(timeout, list) else timeout or PROVIDER_TIMEOUTS[provider]
+
+
+def get_retries():
+    """Retries per request; `integration_http_retries` in site config overrides the default."""
+    retries = frappe.conf.get("integration_http_retries")
+    return DEFAULT_RETRIES if retries is None else retries
+
+
+def request(provider, method, url, retry_on_status=True, **kwargs):
+    """
+    Send a request through the host's pooled session, guarded by the provider's
+    circuit breaker and with its default timeout and retries (see `send`).
+    Pass retry_on_status=False for calls that must never run twice, such as a
+    payment charge: they are then only retried when the connection failed.
+    Connection errors, timeouts and 5xx responses that survive the retries
+    count as failures on the circuit.
+    """
+    acquire(provider)
+    kwargs.setdefault("timeout", get_timeout(provider))
+
+    try:
+        response = send(get_session(url), method, url, get_retries(), retry_on_status, **kwargs)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        record_failure(provider)
+        raise
+
+    if response.status_code >= 500:
+        record_failure(provider)
+    else:
+        record_success(provider)
+
+    return response
+
+
+def send(session, method, url, retries=DEFAULT_RETRIES, retry_on_status=True, **kwargs):
+    """
+    Send a request on `session`, retrying failed attempts up to `retries` times,
+    honouring Retry-After and otherwise backing off exponentially with jitter.
+    Only attempts that cannot have been processed twice are retried: connect
+    failures and 429/503 for every method, 5xx and dropped connections for
+    idempotent ones. With retry_on_status=False, only connect failures are
+    retried. A file body is rewound before each retry; a body that cannot be
+    rewound is not retried. Touches neither frappe.local nor Redis, so it can
+    run in worker threads.
+    """
+    method = method.upper()
+    body = kwargs.get("data")
+    start = body.tell() if hasattr(body, "seek") else None
+    rewindable = body is None or isinstance(body, (str, bytes, dict, list, tuple)) or start is not None
+
+    for attempt in range(retries + 1):
+        can_retry = attempt < retries and rewindable
+        if attempt and start is not None:
+            body.seek(start)
+
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.exceptions.ConnectTimeout:
+            if not can_retry:
+                raise
+            wait = None
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            # The request may have been processed; only idempotent ones are sent again
+            if not can_retry or method not in IDEMPOTENT_METHODS:
+                raise
+            wait = None
+        else:
+            wait = get_retry_wait(method, response) if can_retry and retry_on_status else False
+            if wait is False:
+                return response
+
+        time.sleep(wait if wait is not None else backoff(attempt))
+
+
+def get_retry_wait(method, response):
+    """
+    Seconds to wait before retrying this response, None to use the backoff,
+    or False when it should not be retried.
+    """
+    status = response.status_code
+    if status not in RETRY_ANY_METHOD and not (status in RETRY_IDEMPOTENT and method in IDEMPOTENT_METHODS):
+        return False
+
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+
+    try:
+        wait = float(retry_after)
+    except ValueError:
+        try:
+            wait = parsedate_to_datetime(retry_after).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+
+    if wait > RETRY_AFTER_MAX:
+        return False
+    return max(wait, 0) + random.uniform(0, 1)
+
+
+def backoff(attempt):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, BACKOFF_BASE * 2**attempt)
@@ -0,0 +1,126 @@
+import frappe
+import requests
+from frappe.utils import get_url
+from tenacious_integration.tenacious_integration.circuit_breaker import PROVIDER_TIMEOUTS
+from tenacious_integration.tenacious_integration.settings import get_settings
+from twilio.base.exceptions import TwilioRestException
+from twilio.http.http_client import TwilioHttpClient
+from twilio.request_validator import RequestValidator
+from twilio.rest import Client
+from urllib3.exceptions import NewConnectionError
+
+# (connect, read) seconds for every Twilio REST call
+TWILIO_TIMEOUT = PROVIDER_TIMEOUTS["Twilio"]
+
+TWILIO_API_BASE_URL = "https://api.twilio.com"
+
+_clients = {}  # (site, account_sid) -> (credentials version, Client); a worker may serve several sites
+
+
+class PooledHttpClient(TwilioHttpClient):
+    """
+    Pooled HTTP client with separate connect and read timeouts, optionally
+    sending API calls to another base URL, e.g. a local stub server.
+    """
+
+    def __init__(self, timeout=TWILIO_TIMEOUT, base_url=None, **kwargs):
+        # Twilio validates a single number here; requests itself accepts (connect, read)
+        super().__init__(timeout=timeout[1], **kwargs)
+        self.timeout = timeout
+        self.base_url = base_url.rstrip("/") if base_url else None
+
+    def request(self, method, url, *args, **kwargs):
+        if self.base_url and url.startswith(TWILIO_API_BASE_URL):
+            url = self.base_url + url[len(TWILIO_API_BASE_URL):]
+        return super().request(method, url, *args, **kwargs)
+
+
+def get_twilio_client(settings=None, account_sid=None):
+    """
+    Return a per-process Twilio client for the configured account, or for one
+    of its subaccounts when `account_sid` differs, reusing its keep-alive HTTP
+    session across calls and background jobs. Returns None when credentials
+    are missing from Twilio Settings.
+    """
+    settings = settings or get_settings("Twilio Settings")
+
+    if not settings.account_sid or not settings.auth_token:
+        return None
+
+    account_sid = account_sid or settings.account_sid
+    key = (settings.account_sid, str(settings.modified))
+    client = _clients.get((frappe.local.site, account_sid))
+
+    if not client or client[0] != key:
+        http_client = get_http_client()
+        # Subaccounts are reached with the main account's credentials
+        client = _clients[(frappe.local.site, account_sid)] = (
+            key,
+            Client(settings.account_sid, settings.auth_token, account_sid=account_sid, http_client=http_client),
+        )
+
+    return client[1]
+
+
+def get_http_client():
+    """
+    Build the pooled HTTP client for a Twilio Client. Set `twilio_api_base_url`
+    in site config to point the app at a local stub server for load testing.
+    """
+    return PooledHttpClient(base_url=frappe.conf.get("twilio_api_base_url"), pool_connections=True)
+
+
+def is_valid_twilio_request(settings=None):
+    """
+    Whether webhook data in the current request can be trusted. With Validate
+    Webhook Signatures on in Twilio Settings, the request must carry a valid
+    X-Twilio-Signature, i.e. was sent by Twilio for this account. Form posts are
+    signed over their parameters; JSON bodies over the bodySHA256 hash Twilio
+    adds to the URL, so a JSON body without it is rejected.
+    """
+    settings = settings or get_settings("Twilio Settings")
+    if not settings.validate_webhook_signatures:
+        return True
+
+    signature = frappe.get_request_header("X-Twilio-Signature")
+    if not signature or not settings.auth_token:
+        return False
+
+    # Twilio signs the public URL it called, which may differ from what the proxy passed on
+    request = frappe.request
+    url = get_url(request.path)
+    if request.query_string:
+        url += "?" + request.query_string.decode()
+
+    if request.mimetype == "application/x-www-form-urlencoded":
+        params = request.form
+    elif "bodySHA256" in request.args:
+        params = request.get_data(as_text=True)
+    else:
+        return False
+
+    return RequestValidator(settings.auth_token).validate(url, params, signature)
+
+
+def clear_twilio_clients():
+    """Forget cached clients so the next call picks up new credentials."""
+    _clients.clear()
+
+
+def is_transient_error(e):
+    """Whether a failed Twilio call points at Twilio being unavailable rather than at the request."""
+    return not isinstance(e, TwilioRestException) or (e.status or 0) >= 500
+
+
+def may_have_been_sent(e):
+    """
+    Whether a Twilio call that failed without an answer may still have created
+    the message: the request went out, but the response never came back.
+    """
+    if isinstance(e, (TwilioRestException, requests.exceptions.ConnectTimeout)):
+        return False
+    if isinstance(e, requests.exceptions.ConnectionError):
+        # Refused or unresolvable connections never carried the request
+        reason = getattr(e.args[0], "reason", None) if e.args else None
+        return not isinstance(reason, NewConnectionError)
+    return isinstance(e, requests.exceptions.Timeout)
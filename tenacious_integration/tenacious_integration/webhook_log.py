@@ -0,0 +1,42 @@
+import json
+import random
+import frappe
+from tenacious_integration.tenacious_integration.settings import get_settings
+
+WEBHOOK_EVENTS_KEY = "tenacious_integration:webhook_events"
+WEBHOOK_EVENTS_MAX = 1000  # events kept in the Redis ring buffer
+
+
+def log_webhook_event(source, data, force=False):
+    """
+    Record a sample of incoming webhook payloads as structured JSON lines in the
+    app logger and in a fixed-size Redis ring buffer, instead of Error Log.
+    The share of events kept is the Webhook Log Sample Rate in Twilio Settings.
+    """
+    if not force:
+        rate = get_settings("Twilio Settings").webhook_log_sample_rate or 0
+        if rate <= 0 or random.random() * 100 >= rate:
+            return
+
+    event = json.dumps(
+        {"source": source, "received_at": frappe.utils.now(), "data": data},
+        separators=(",", ":"),
+        default=str,
+    )
+    frappe.logger("tenacious_integration.webhooks").info(event)
+
+    cache = frappe.cache()
+    pipe = cache.pipeline()
+    pipe.lpush(cache.make_key(WEBHOOK_EVENTS_KEY), event)
+    pipe.ltrim(cache.make_key(WEBHOOK_EVENTS_KEY), 0, WEBHOOK_EVENTS_MAX - 1)
+    pipe.execute()
+
+
+@frappe.whitelist()
+def get_recent_webhook_events(limit=100):
+    """Return the most recent sampled webhook events, newest first."""
+    frappe.only_for("System Manager")
+
+    cache = frappe.cache()
+    events = cache.lrange(WEBHOOK_EVENTS_KEY, 0, frappe.utils.cint(limit) - 1)
+    return [json.loads(event) for event in events]
@@ -1,91 +1,372 @@
+import json
+import time
 import frappe
 from frappe.model.workflow import get_workflow_name
+from frappe.utils import cint
+from tenacious_integration.tenacious_integration.doctype.whatsapp_message_log.whatsapp_message_log import (
+    bulk_insert_message_logs,
+)
+from tenacious_integration.tenacious_integration.dispatcher import enqueue_dispatch
+from tenacious_integration.tenacious_integration.phone import normalize_recipient
+from tenacious_integration.tenacious_integration.settings import get_settings
+
+WORKFLOW_META_CACHE_KEY = "tenacious_integration:workflow_meta"
+WORKFLOW_META_VERSION_KEY = "tenacious_integration:workflow_meta_version"
+WORKFLOW_RECIPIENTS_CACHE_KEY = "tenacious_integration:workflow_recipients"
+DIGEST_QUEUE_KEY = "tenacious_integration:digest"
+DIGEST_DUE_KEY = "tenacious_integration:digest_due"
+
+# Trim the flushed entries off a digest and, in the same step, drop its due
+# entry or, if notifications arrived since it was read, give them a new window
+REMOVE_FLUSHED_DIGEST_SCRIPT = """
+redis.call('LTRIM', KEYS[1], ARGV[1], -1)
+if redis.call('LLEN', KEYS[1]) == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[2])
+else
+    redis.call('ZADD', KEYS[2], ARGV[3], ARGV[2])
+end
+"""
+
+SUMMARY_FIELDTYPES = ("Data", "Select", "Text", "Datetime")
+DEFAULT_NOTIFICATION_TEMPLATE = (
+    "📢 Update: {{ doc.doctype }} {{ doc.name }} has transitioned to '{{ state }}'.\n"
+    "{% for label, fieldname in fields %}{% if doc.get(fieldname) %}"
+    "{{ label }}: {{ doc.get(fieldname) }}\n"
+    "{% endif %}{% endfor %}"
+)
+
+# Per-process caches, keyed by site since a worker may serve several
+_workflow_meta = {}
+_compiled_templates = {}
+
 
 def send_whatsapp_on_workflow_transition(doc, method):
     """
     Dynamically send WhatsApp messages when a workflow state changes.
     Only sends if enable_whatsapp_workflow_messages is checked in Twilio Settings.
     """
+    meta = get_workflow_meta(doc.doctype)
+
+    if not meta["workflow"]:
+        return  # Messaging disabled or no workflow for this doctype, exit
 
-    if not frappe.db.get_single_value("Twilio Settings", "enable_whatsapp_workflow_messages"):
+    current_state = doc.get(meta["state_field"])
+
+    if not current_state or current_state not in meta["states"]:
+        return  # No workflow state found or nobody to notify, exit
+
+    # Skip saves that did not move the document to a new state
+    doc_before_save = doc.get_doc_before_save()
+    if doc_before_save and doc_before_save.get(meta["state_field"]) == current_state:
         return
-    
-    # Get Workflow Name for the Doctype
-    workflow = get_workflow_name(doc.doctype)
 
+    # Render the precompiled template for this doctype and state
+    message = render_notification_message(doc, current_state, meta)
+
+    # Fan out to recipients in a background job once the save is committed
+    frappe.enqueue(
+        "tenacious_integration.tenacious_integration.whatsapp_webhook.send_workflow_notifications",
+        queue="short",
+        enqueue_after_commit=True,
+        doctype=doc.doctype,
+        docname=doc.name,
+        state=current_state,
+        message=message,
+    )
+
+
+def get_workflow_meta(doctype):
+    """
+    Return the cached workflow metadata for a doctype as a dict with
+    `workflow`, `state_field` and `states` ({state: [roles allowed to edit]}).
+    `workflow` is None when there is no active workflow or messaging is disabled.
+
+    Each worker keeps its copy while the shared version in Redis is unchanged,
+    so a lookup costs one short GET instead of reading the pickled hash.
+    """
+    version = frappe.cache().get_value(WORKFLOW_META_VERSION_KEY)
+    if not version:
+        version = frappe.generate_hash(length=10)
+        frappe.cache().set_value(WORKFLOW_META_VERSION_KEY, version)
+
+    key = (frappe.local.site, doctype)
+    cached = _workflow_meta.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    meta = frappe.cache().hget(
+        f"{WORKFLOW_META_CACHE_KEY}:{version}", doctype, generator=lambda: build_workflow_meta(doctype)
+    )
+    _workflow_meta[key] = (version, meta)
+    return meta
+
+
+def build_workflow_meta(doctype):
+    """Read workflow name, state field and notifiable states for a doctype from the database."""
+    meta = {"workflow": None, "state_field": None, "states": {}, "fields": [], "templates": {}, "digest_window": 0}
+
+    if not get_settings("Twilio Settings").enable_whatsapp_workflow_messages:
+        return meta
+
+    workflow = get_workflow_name(doctype)
     if not workflow:
-        return  # No workflow exists for this doctype, exit
+        return meta
 
-    # Fetch Workflow State Field
-    workflow_state_field = frappe.get_value("Workflow", workflow, "workflow_state_field")
-    current_state = doc.get(workflow_state_field)
+    meta["workflow"] = workflow
+    meta["state_field"] = frappe.get_value("Workflow", workflow, "workflow_state_field")
 
-    if not current_state:
-        return  # No workflow state found, exit
+    for row in frappe.get_all(
+        "Workflow Document State",
+        filters={"parent": workflow},
+        fields=["state", "allow_edit"],
+    ):
+        if row.allow_edit:
+            meta["states"].setdefault(row.state, []).append(row.allow_edit)
 
-    # Find recipients dynamically based on the workflow state
-    recipients = get_recipients_for_workflow(doc.doctype, current_state)
+    meta["fields"] = [
+        (df.label, df.fieldname)
+        for df in frappe.get_meta(doctype).fields
+        if df.fieldtype in SUMMARY_FIELDTYPES
+    ]
+    meta["templates"] = get_notification_templates(doctype)
+    meta["digest_window"] = cint(
+        frappe.db.get_value(
+            "WhatsApp Notification Digest",
+            {"parent": "WhatsApp Settings", "document_type": doctype},
+            "window_seconds",
+        )
+    )
 
-    if not recipients:
-        return  # No recipients to send messages to
+    return meta
 
-    # Construct the message dynamically
-    message = f"📢 Update: {doc.doctype} {doc.name} has transitioned to '{current_state}'.\n"
 
-    # Add document details dynamically
-    for field in doc.meta.get("fields"):
-        if field.get("fieldtype") in ["Data", "Select", "Text", "Datetime"] and doc.get(field.get("fieldname")):
-            message += f"{field.get('label')}: {doc.get(field.get('fieldname'))}\n"
+def get_notification_templates(doctype):
+    """
+    Map workflow state to template source for a doctype. The "" key holds the
+    template used for any other state, falling back to the WhatsApp Settings
+    default and then to the built-in message.
+    """
+    templates = {}
+    for row in frappe.get_all(
+        "WhatsApp Notification Template",
+        filters={"parent": "WhatsApp Settings", "document_type": doctype},
+        fields=["workflow_state", "message_template"],
+        order_by="idx",
+    ):
+        templates.setdefault(row.workflow_state or "", row.message_template)
 
-    # Log and send WhatsApp messages
-    for recipient in recipients:
-        log_and_send_whatsapp_message(doc, recipient, message, current_state)
+    templates.setdefault(
+        "",
+        get_settings("WhatsApp Settings").default_message_template
+        or DEFAULT_NOTIFICATION_TEMPLATE,
+    )
+    return templates
+
+
+def render_notification_message(doc, state, meta):
+    """
+    Render the notification for a document, compiling each template source once
+    per process. Runs inside the save, so a broken template is logged and the
+    built-in message sent instead of failing every save of the doctype.
+    """
+    source = meta["templates"].get(state) or meta["templates"][""]
+
+    try:
+        return compile_template(source).render(doc=doc, state=state, fields=meta["fields"])
+    except Exception:
+        frappe.log_error(f"WhatsApp Notification Template Error: {doc.doctype} ({state})", frappe.get_traceback())
+        return compile_template(DEFAULT_NOTIFICATION_TEMPLATE).render(doc=doc, state=state, fields=meta["fields"])
+
+
+def compile_template(source):
+    key = (frappe.local.site, source)
+    template = _compiled_templates.get(key)
+    if not template:
+        template = _compiled_templates[key] = frappe.get_jenv().from_string(source)
+    return template
+
+
+def clear_workflow_meta_cache(doc=None, method=None):
+    """
+    Drop cached workflow metadata in every worker, which see the new version on
+    their next lookup. Hooked to Workflow, Custom Field and settings updates.
+    """
+    _workflow_meta.clear()
+    retire_workflow_meta_version()
+    # Retire it again once committed, in case another worker rebuilt from the old rows meanwhile
+    frappe.db.after_commit.add(retire_workflow_meta_version)
+    clear_workflow_recipients_cache()
+
+
+def retire_workflow_meta_version():
+    version = frappe.cache().get_value(WORKFLOW_META_VERSION_KEY)
+    if version:
+        frappe.cache().delete_value(f"{WORKFLOW_META_CACHE_KEY}:{version}")
+    frappe.cache().delete_value(WORKFLOW_META_VERSION_KEY)
 
 
 def get_recipients_for_workflow(doctype, state):
     """
     Fetch recipients dynamically based on workflow state.
-    This can be based on User Roles, Assigned Users, or Custom Rules.
+    Mobile numbers of users holding a role allowed to edit the state are
+    cached per doctype and state.
     """
-    workflow_states = frappe.get_all(
-        "Workflow Document State",
-        filters={"parent": get_workflow_name(doctype), "state": state},
-        fields=["allow_edit"]
+    return frappe.cache().hget(
+        WORKFLOW_RECIPIENTS_CACHE_KEY,
+        f"{doctype}:{state}",
+        generator=lambda: get_mobile_numbers_for_roles(get_workflow_meta(doctype)["states"].get(state)),
     )
 
-    users = []
-    for state in workflow_states:
-        users += frappe.get_all("Has Role", filters={"role": state["allow_edit"]}, pluck="parent")
 
-    phone_numbers = [
-        frappe.get_value("User", user, "mobile_no") for user in set(users) if user
-    ]
-    return [num for num in phone_numbers if num]  # Remove empty numbers
+def get_mobile_numbers_for_roles(roles):
+    """
+    Return the distinct mobile numbers of users having any of the given roles,
+    in one query. Numbers are normalized to E.164, so the cached recipients
+    need no further formatting; numbers that are not valid are left out.
+    """
+    if not roles:
+        return []
+
+    HasRole = frappe.qb.DocType("Has Role")
+    User = frappe.qb.DocType("User")
+
+    numbers = (
+        frappe.qb.from_(HasRole)
+        .join(User)
+        .on(User.name == HasRole.parent)
+        .select(User.mobile_no)
+        .distinct()
+        .where(HasRole.parenttype == "User")
+        .where(HasRole.role.isin(roles))
+        .where(User.mobile_no.isnotnull())
+        .where(User.mobile_no != "")
+    ).run(pluck=True)
+
+    settings = get_settings("Twilio Settings")
+    normalized = (normalize_recipient(settings, number) for number in numbers)
+    return list(dict.fromkeys(number for number in normalized if number))
+
+
+def clear_workflow_recipients_cache(doc=None, method=None):
+    """Drop the cached state recipients. Hooked to User updates, which carry the Has Role rows."""
+    frappe.cache().delete_value(WORKFLOW_RECIPIENTS_CACHE_KEY)
 
 
-def log_and_send_whatsapp_message(doc, recipient, message, status):
+def send_workflow_notifications(doctype, docname, state, message):
     """
-    Logs the WhatsApp message and triggers sending it via the API.
+    Background job: resolve recipients for a workflow state and log one
+    WhatsApp Message Log per recipient in bulk. The logs go out through the
+    dispatcher in the Low priority lane, behind transactional messages.
+    Doctypes with a coalescing window collect notifications into digests instead.
     """
-    try:
-        # Create a WhatsApp Message Log entry
-        whatsapp_log = frappe.get_doc({
-            "doctype": "WhatsApp Message Log",
+    recipients = get_recipients_for_workflow(doctype, state)
+
+    if not recipients:
+        return
+
+    digest_window = get_workflow_meta(doctype)["digest_window"]
+    if digest_window:
+        add_to_digests(doctype, docname, recipients, message, digest_window)
+        return
+
+    bulk_insert_message_logs([
+        {
             "to_number": recipient,
-            "message_type": "Text",
             "message_content": message,
-            "status": "Queued",
-            "reference_doctype": doc.doctype,
-            "reference_name": doc.name
+            "reference_doctype": doctype,
+            "reference_name": docname,
+            "priority": "Low",
+        }
+        for recipient in recipients
+    ])
+    frappe.db.commit()
+
+    enqueue_dispatch()
+
+
+def add_to_digests(doctype, docname, recipients, message, window):
+    """
+    Append a notification to each recipient's pending digest in Redis. The
+    first notification of a digest sets when it is due; later ones within the
+    window join it.
+    """
+    cache = frappe.cache()
+    due = time.time() + window
+    entry = json.dumps({"docname": docname, "message": message})
+
+    pipe = cache.pipeline()
+    for recipient in recipients:
+        member = f"{doctype}|{recipient}"
+        pipe.rpush(cache.make_key(f"{DIGEST_QUEUE_KEY}:{member}"), entry)
+        pipe.zadd(cache.make_key(DIGEST_DUE_KEY), {member: due}, nx=True)
+    pipe.execute()
+
+
+def flush_notification_digests():
+    """
+    Scheduler entry point: turn every digest whose window has elapsed into one
+    WhatsApp Message Log. Digests are only removed from Redis once their logs
+    are committed, so a failed insert leaves them for the next run.
+    """
+    cache = frappe.cache()
+
+    # Raw pipelines, like add_to_digests, so every key is prefixed exactly once
+    pipe = cache.pipeline()
+    pipe.zrangebyscore(cache.make_key(DIGEST_DUE_KEY), "-inf", time.time())
+    members = [frappe.safe_decode(member) for member in pipe.execute()[0]]
+    if not members:
+        return
+
+    pipe = cache.pipeline()
+    for member in members:
+        pipe.lrange(cache.make_key(f"{DIGEST_QUEUE_KEY}:{member}"), 0, -1)
+
+    logs, taken = [], []
+    for member, entries in zip(members, pipe.execute()):
+        doctype, recipient = member.split("|", 1)
+        taken.append((member, len(entries), get_workflow_meta(doctype)["digest_window"]))
+        if not entries:
+            continue
+
+        entries = [json.loads(entry) for entry in entries]
+        logs.append({
+            "to_number": recipient,
+            "message_content": build_digest_message(doctype, entries),
+            "reference_doctype": doctype,
+            "reference_name": entries[0]["docname"] if len({e["docname"] for e in entries}) == 1 else None,
+            "priority": "Low",
         })
-        whatsapp_log.insert(ignore_permissions=True)
+
+    if logs:
+        bulk_insert_message_logs(logs)
         frappe.db.commit()
 
-        # Call the API function with the document name
-        from tenacious_integration.tenacious_integration.api import send_whatsapp_message
-        send_whatsapp_message(doc_name=whatsapp_log.name)
+    remove_flushed_digests(taken)
+
+    if logs:
+        enqueue_dispatch()
+
+
+def remove_flushed_digests(taken):
+    """
+    Drop the entries that were sent from each digest. Notifications that
+    arrived meanwhile stay queued and start a new window.
+    """
+    cache = frappe.cache()
+    script = cache.register_script(REMOVE_FLUSHED_DIGEST_SCRIPT)
+    due = time.time()
+
+    for member, count, window in taken:
+        script(
+            keys=[cache.make_key(f"{DIGEST_QUEUE_KEY}:{member}"), cache.make_key(DIGEST_DUE_KEY)],
+            args=[count, member, due + (window or 0)],
+        )
 
 
-    except Exception as e:
-        frappe.log_error("WhatsApp Messaging Error", f"Error sending WhatsApp message: {str(e)}, Traceback: {frappe.get_traceback()}")
+def build_digest_message(doctype, entries):
+    """Merge pending notifications for one recipient into a single message."""
+    if len(entries) == 1:
+        return entries[0]["message"]
 
+    header = f"📢 {len(entries)} updates for {doctype}:"
+    return "\n\n".join([header] + [entry["message"].strip() for entry in entries])